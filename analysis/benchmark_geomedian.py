@@ -0,0 +1,128 @@
+#!/bin/env python
+"""
+:mod:`benchmark_geomedian` - Benchmark the geomedian engine on synthetic
+stacks.
+===============================================================================
+
+Compares the block-vectorised Weiszfeld iteration of :mod:`geomedian` with a
+plain per-pixel implementation (the approach of ``hdmedians``, which
+``StatsApp`` uses) on a sample of pixels, checks that both agree, and times
+whole tiles reduced serially and in a process pool.
+
+"""
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from geomedian import NODATA, geomedian_tile
+
+
+def weiszfeld_pixel(x, eps=1e-2, max_iter=1000):
+    """
+    Geometric median of one pixel, iterating on its own.
+
+    :param x: the valid observations, (time, band) float
+
+    :returns: the geometric median, (band,) float
+
+    """
+
+    estimate = x.mean(axis=0)
+    for _ in range(max_iter):
+        distance = np.maximum(np.sqrt(((x - estimate) ** 2).sum(axis=1)), 1e-6)
+        new = (x / distance[:, np.newaxis]).sum(axis=0) / (1 / distance).sum()
+        if np.sqrt(((new - estimate) ** 2).sum()) <= eps:
+            return new
+        estimate = new
+    return estimate
+
+
+def synthetic_stack(timesteps, size, n_bands=6, seed=0):
+    """
+    Make a stack of int16 observations of a stable surface, with noise,
+    bright cloud outliers and nodata.
+
+    :param timesteps: the length of the time axis
+    :param size: the width and height of the tile
+    :param n_bands: the number of bands
+    :param seed: the random seed
+
+    :returns: a (time, band, y, x) int16 array
+
+    """
+
+    rng = np.random.RandomState(seed)
+    surface = rng.uniform(200, 4000, (1, n_bands, size, size))
+    stack = rng.normal(surface, 150, (timesteps, n_bands, size, size))
+    cloudy = rng.random_sample((timesteps, 1, size, size)) < 0.2
+    stack = np.where(cloudy, rng.uniform(5000, 9000, stack.shape), stack)
+    stack = stack.astype(np.int16)
+    missing = rng.random_sample((timesteps, 1, size, size)) < 0.1
+    stack[np.broadcast_to(missing, stack.shape)] = NODATA
+    return stack
+
+
+def per_pixel(stack, pixels):
+    n_time, n_band = stack.shape[:2]
+    flat = stack.reshape(n_time, n_band, -1)
+    result = np.empty((n_band, len(pixels)))
+    for k, pixel in enumerate(pixels):
+        x = flat[:, :, pixel]
+        x = x[(x != NODATA).all(axis=1)].astype(np.float64)
+        result[:, k] = weiszfeld_pixel(x) if len(x) else NODATA
+    return result
+
+
+def benchmark():
+    parser = argparse.ArgumentParser(description='Benchmark the geomedian engine.')
+    parser.add_argument('--timesteps', type=int, default=40,
+                        help='observations per pixel (default: 40, about a year of Landsat 7 and 8)')
+    parser.add_argument('--size', type=int, default=256,
+                        help='width and height of a tile in pixels (default: 256)')
+    parser.add_argument('--tiles', type=int, default=4,
+                        help='number of tiles reduced in the pool (default: 4)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--sample', type=int, default=2000,
+                        help='pixels reduced per pixel for the comparison (default: 2000)')
+    args = parser.parse_args()
+
+    stack = synthetic_stack(args.timesteps, args.size)
+    n_pixels = args.size * args.size
+    print('tile: {0} observations x 6 bands x {1} x {1} pixels'.format(args.timesteps, args.size))
+
+    start = time.time()
+    result = geomedian_tile(stack)
+    vectorised = time.time() - start
+    print('block-vectorised: {0:.2f} s per tile'.format(vectorised))
+
+    pixels = np.random.RandomState(1).choice(n_pixels, min(args.sample, n_pixels),
+                                             replace=False)
+    start = time.time()
+    expected = per_pixel(stack, pixels)
+    elapsed = (time.time() - start) * n_pixels / len(pixels)
+    print('per-pixel:        {0:.2f} s per tile (extrapolated from {1} pixels)'.format(
+        elapsed, len(pixels)))
+    difference = np.abs(result.reshape(6, -1)[:, pixels] - np.rint(expected))
+    print('largest difference on the sample: {0:.0f} (reflectance units)'.format(
+        difference.max()))
+
+    stacks = [synthetic_stack(args.timesteps, args.size, seed=seed)
+              for seed in range(args.tiles)]
+    start = time.time()
+    for tile in stacks:
+        geomedian_tile(tile)
+    serial = time.time() - start
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        start = time.time()
+        list(executor.map(geomedian_tile, stacks))
+        parallel = time.time() - start
+    print('{0} tiles: {1:.2f} s serial, {2:.2f} s in the process pool'.format(
+        args.tiles, serial, parallel))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,226 @@
+#!/bin/env python
+"""
+:mod:`benchmark_water_classifier` - Compare the chunked water classifier with
+the notebook version.
+===============================================================================
+
+Both classify the same synthetic stack: the notebook version the float64
+stack with NaN nodata it gets from ``load_combine_mask_discard``, the chunked
+version the int16 stack with -9999 nodata. Runtime and peak memory (numpy
+allocations traced by :mod:`tracemalloc`) are reported, and the outputs
+checked to be identical. Expect the runtimes to be close; the chunked
+version's gain is its memory.
+
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import numpy as np
+
+from water_classifier import NODATA, classify
+
+
+def notebook_run_regression(band1, band2, band3, band4, band5, band7):
+    """
+    ``_run_regression`` of ``water_classifier`` in
+    ``notebooks/water_classifier_and_WOfS.ipynb``, unchanged but for the
+    nodata fill value, which numpy >= 2 refuses to wrap into uint8. Every
+    pixel is reassigned by the tree, so the fill value never shows.
+
+    """
+
+    def _band_ratio(a, b):
+        return (a - b) / (a + b)
+
+    shape = band1.shape
+    no_data = np.array(-9999).astype('uint8')
+
+    ndi_52 = _band_ratio(band5, band2)
+    ndi_43 = _band_ratio(band4, band3)
+    ndi_72 = _band_ratio(band7, band2)
+
+    classified = np.full(shape, no_data, dtype='uint8')
+
+    r1 = ndi_52 <= -0.01
+
+    r2 = band1 <= 2083.5
+    classified[r1 & ~r2] = 0  #Node 3
+
+    r3 = band7 <= 323.5
+    _tmp = r1 & r2
+    _tmp2 = _tmp & r3
+    _tmp &= ~r3
+
+    r4 = ndi_43 <= 0.61
+    classified[_tmp2 & r4] = 1  #Node 6
+    classified[_tmp2 & ~r4] = 0  #Node 7
+
+    r5 = band1 <= 1400.5
+    _tmp2 = _tmp & ~r5
+
+    r6 = ndi_43 <= -0.01
+    classified[_tmp2 & r6] = 1  #Node 10
+    classified[_tmp2 & ~r6] = 0  #Node 11
+
+    _tmp &= r5
+
+    r7 = ndi_72 <= -0.23
+    _tmp2 = _tmp & ~r7
+
+    r8 = band1 <= 379
+    classified[_tmp2 & r8] = 1  #Node 14
+    classified[_tmp2 & ~r8] = 0  #Node 15
+
+    _tmp &= r7
+
+    r9 = ndi_43 <= 0.22
+    classified[_tmp & r9] = 1  #Node 17
+    _tmp &= ~r9
+
+    r10 = band1 <= 473
+    classified[_tmp & r10] = 1  #Node 19
+    classified[_tmp & ~r10] = 0  #Node 20
+
+    del r2, r3, r4, r5, r6, r7, r8, r9, r10
+    gc.collect()
+
+    r1 = ~r1
+
+    r11 = ndi_52 <= 0.23
+    _tmp = r1 & r11
+
+    r12 = band1 <= 334.5
+    _tmp2 = _tmp & ~r12
+    classified[_tmp2] = 0  #Node 23
+
+    _tmp &= r12
+
+    r13 = ndi_43 <= 0.54
+    _tmp2 = _tmp & ~r13
+    classified[_tmp2] = 0  #Node 25
+
+    _tmp &= r13
+
+    r14 = ndi_52 <= 0.12
+    _tmp2 = _tmp & r14
+    classified[_tmp2] = 1  #Node 27
+
+    _tmp &= ~r14
+
+    r15 = band3 <= 364.5
+    _tmp2 = _tmp & r15
+
+    r16 = band1 <= 129.5
+    classified[_tmp2 & r16] = 1  #Node 31
+    classified[_tmp2 & ~r16] = 0  #Node 32
+
+    _tmp &= ~r15
+
+    r17 = band1 <= 300.5
+    _tmp2 = _tmp & ~r17
+    _tmp &= r17
+    classified[_tmp] = 1  #Node 33
+    classified[_tmp2] = 0  #Node 34
+
+    _tmp = r1 & ~r11
+
+    r18 = ndi_52 <= 0.34
+    classified[_tmp & ~r18] = 0  #Node 36
+    _tmp &= r18
+
+    r19 = band1 <= 249.5
+    classified[_tmp & ~r19] = 0  #Node 38
+    _tmp &= r19
+
+    r20 = ndi_43 <= 0.45
+    classified[_tmp & ~r20] = 0  #Node 40
+    _tmp &= r20
+
+    r21 = band3 <= 364.5
+    classified[_tmp & ~r21] = 0  #Node 42
+    _tmp &= r21
+
+    r22 = band1 <= 129.5
+    classified[_tmp & r22] = 1  #Node 44
+    classified[_tmp & ~r22] = 0  #Node 45
+
+    return classified
+
+
+def synthetic_stack(timesteps, size, nodata_fraction=0.2, seed=0):
+    """
+    Make a stack of six int16 surface reflectance bands mixing land-like and
+    water-like pixels, with nodata scattered over each band.
+
+    :param timesteps: the length of the time axis
+    :param size: the width and height of each time slice
+    :param nodata_fraction: the fraction of nodata pixels per band
+    :param seed: the random seed
+
+    :returns: a list of six (time, y, x) int16 arrays, blue to swir2
+
+    """
+
+    rng = np.random.RandomState(seed)
+    shape = (timesteps, size, size)
+    water = rng.random_sample(shape) < 0.3
+    # blue, green, red, nir, swir1, swir2 of land and of water
+    land_means = (500, 800, 900, 2800, 2200, 1400)
+    water_means = (400, 500, 350, 200, 120, 80)
+    bands = []
+    for land_mean, water_mean in zip(land_means, water_means):
+        mean = np.where(water, water_mean, land_mean)
+        band = rng.normal(mean, mean * 0.5).clip(-100, 16000).astype(np.int16)
+        band[rng.random_sample(shape) < nodata_fraction] = NODATA
+        bands.append(band)
+    return bands
+
+
+def _measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def benchmark():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the chunked water classifier against the notebook version.')
+    parser.add_argument('--timesteps', type=int, default=1000,
+                        help='number of time slices (default: 1000)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='width and height of each time slice in pixels (default: 64)')
+    args = parser.parse_args()
+
+    bands = synthetic_stack(args.timesteps, args.size)
+    float_bands = []
+    for band in bands:
+        band = band.astype(np.float64)
+        band[band == NODATA] = np.nan
+        float_bands.append(band)
+
+    print('stack: {0} x {1} x {1} pixels, 6 bands'.format(args.timesteps, args.size))
+    print('input: int16 {0:.0f} MB, float64 {1:.0f} MB'.format(
+        sum(b.nbytes for b in bands) / 2. ** 20,
+        sum(b.nbytes for b in float_bands) / 2. ** 20))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected, elapsed, peak = _measure(notebook_run_regression, *float_bands)
+    print('notebook: {0:.2f} s, peak {1:.0f} MB'.format(elapsed, peak / 2. ** 20))
+
+    classified, elapsed, peak = _measure(classify, *bands)
+    print('chunked:  {0:.2f} s, peak {1:.0f} MB'.format(elapsed, peak / 2. ** 20))
+
+    print('identical: {0} ({1} water pixels)'.format(
+        np.array_equal(expected, classified), int(np.count_nonzero(classified))))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,44 @@
+"""
+:mod:`download_modules` - Modules of the download scripts used in analysis.
+===============================================================================
+
+The memory-mapped reader of unpacked scenes (``tiff_band``) lives with the
+download scripts, which summarise every scene while unpacking it without the
+analysis scripts. It is loaded here from its file, under its own name, so the
+analysis scripts share it without putting the rest of ``download_script`` on
+the import path.
+
+"""
+
+import importlib.util
+import os
+import sys
+
+DOWNLOAD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'download_script')
+
+
+def load_module(name):
+    """
+    Load a module of the download scripts, once.
+
+    :param name: the module name, e.g. 'tiff_band'
+
+    :returns: the module
+
+    """
+
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(DOWNLOAD_SCRIPT, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except Exception:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+
+tiff_band = load_module('tiff_band')
@@ -0,0 +1,412 @@
+#!/bin/env python
+"""
+:mod:`geomedian` - Tile-parallel geometric median of Landsat Level-2 stacks.
+===============================================================================
+
+Computes the ``ls_level2_geomedian_annual`` product of
+``geomedian/geomed_product.yaml`` without ``StatsApp`` holding the whole stack
+in memory: every tile of the product grid (30720 m) is loaded, reduced and
+written by a worker process of its own.
+
+Within a tile the Weiszfeld iteration runs over blocks of pixels at once. A
+pixel leaves the iteration as soon as its estimate moves less than ``eps``
+(in surface reflectance units), so the work left shrinks with every iteration
+instead of every pixel iterating as long as the slowest one.
+
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import yaml
+
+try:
+    from datacube import Datacube
+    from datacube.utils import geometry
+    from tile_loader import load_sensor, merge_sensors
+except ImportError:
+    Datacube = None
+
+try:
+    import rasterio
+    from affine import Affine
+except ImportError:
+    rasterio = None
+
+NODATA = -9999
+
+PRODUCT_YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'geomedian', 'geomed_product.yaml')
+
+# pixels of a tile reduced at a time
+BLOCK_SIZE = 1024
+
+# farthest an area may reach, in degrees of longitude from the central
+# meridian, to be gridded in a WGS 84 / UTM crs; a national grid may stretch
+# one zone over its neighbours, but not to the other side of the globe
+MAX_UTM_OFFSET = 30
+
+
+def geomedian_block(block, nodata=NODATA, eps=1e-2, max_iter=1000):
+    """
+    Geometric median of every pixel of a block over time, by Weiszfeld's
+    algorithm. Observations with nodata in any band are left out.
+
+    :param block: the observations, (time, band, pixel) int16
+    :param nodata: the nodata value
+    :param eps: the step size, in reflectance units, under which a pixel has
+                converged
+    :param max_iter: the most iterations of any pixel
+
+    :returns: the geometric median, (band, pixel) int16, nodata where a pixel
+              has no valid observation
+
+    """
+
+    valid = (block != nodata).all(axis=1)
+    count = valid.sum(axis=0)
+    # band-major, so the band loops below work on contiguous (time, pixel)
+    # planes rather than on (time, band, pixel) temporaries
+    data = block.transpose(1, 0, 2).astype(np.float32)
+    data *= valid
+
+    # start from the mean of the valid observations
+    median = data.sum(axis=1) / np.maximum(count, 1)
+
+    # pixels with fewer than two observations are done already
+    active = np.flatnonzero(count > 1)
+    x = data[:, :, active]
+    weights_valid = valid[:, active].astype(np.float32)
+    estimate = median[:, active]
+
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        distance = np.zeros(x.shape[1:], dtype=np.float32)
+        for band in range(x.shape[0]):
+            difference = x[band] - estimate[band]
+            difference *= difference
+            distance += difference
+        np.sqrt(distance, out=distance)
+        # an estimate on an observation would weigh it infinitely
+        np.maximum(distance, 1e-6, out=distance)
+        weights = np.divide(weights_valid, distance, out=distance)
+        new = np.einsum('tp,btp->bp', weights, x) / weights.sum(axis=0)
+        step = np.sqrt(((new - estimate) ** 2).sum(axis=0))
+        median[:, active] = new
+
+        moving = step > eps
+        active = active[moving]
+        x = x[:, :, moving]
+        weights_valid = weights_valid[:, moving]
+        estimate = new[:, moving]
+
+    result = np.rint(median).clip(-32768, 32767).astype(np.int16)
+    result[:, count == 0] = nodata
+    return result
+
+
+def geomedian_tile(stack, nodata=NODATA, eps=1e-2, max_iter=1000,
+                   block_size=BLOCK_SIZE):
+    """
+    Geometric median of a tile, a block of pixels at a time.
+
+    :param stack: the observations, (time, band, y, x) int16
+    :param nodata: the nodata value
+    :param eps: the step size, in reflectance units, under which a pixel has
+                converged
+    :param max_iter: the most iterations of any pixel
+    :param block_size: the number of pixels reduced at a time
+
+    :returns: the geometric median, (band, y, x) int16
+
+    """
+
+    n_time, n_band, height, width = stack.shape
+    pixels = stack.reshape(n_time, n_band, height * width)
+    result = np.empty((n_band, height * width), dtype=np.int16)
+    for start in range(0, height * width, block_size):
+        block = slice(start, start + block_size)
+        result[:, block] = geomedian_block(pixels[:, :, block], nodata, eps,
+                                           max_iter)
+    return result.reshape(n_band, height, width)
+
+
+def read_product(product_yaml=PRODUCT_YAML):
+    """
+    Read the output grid and bands of the product definition.
+
+    :param product_yaml: the product definition
+
+    :returns: a dictionary with the product name, crs, tile size (x, y),
+              resolution (y, x), band names and nodata value
+
+    """
+
+    with open(product_yaml) as f:
+        product = yaml.safe_load(f)
+    storage = product['storage']
+    measurements = product['measurements']
+    return {'name': product['name'],
+            'crs': storage['crs'],
+            'tile_size': (storage['tile_size']['x'], storage['tile_size']['y']),
+            'resolution': (storage['resolution']['y'], storage['resolution']['x']),
+            'bands': [measurement['name'] for measurement in measurements],
+            'nodata': measurements[0]['nodata']}
+
+
+def utm_zone(crs):
+    """
+    Get the zone of a WGS 84 / UTM crs.
+
+    :param crs: the crs, e.g. 'EPSG:32614'
+
+    :returns: the zone, negative in the southern hemisphere, or None if the
+              crs is not a WGS 84 / UTM one
+
+    """
+
+    authority, _, code = str(crs).upper().partition(':')
+    if authority != 'EPSG' or not code.isdigit():
+        return None
+    code = int(code)
+    if 32601 <= code <= 32660:
+        return code - 32600
+    if 32701 <= code <= 32760:
+        return 32700 - code
+    return None
+
+
+def check_crs(product, x, y):
+    """
+    Check that the crs of the product grid suits an area. Only WGS 84 / UTM
+    crs are checked: the area must lie within :data:`MAX_UTM_OFFSET` degrees
+    of longitude of the central meridian of the zone.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param x: the (min, max) longitude of the area
+    :param y: the (min, max) latitude of the area
+
+    :raises ValueError: if the area is too far from the zone of the crs
+
+    """
+
+    zone = utm_zone(product['crs'])
+    if zone is None:
+        return
+    central_meridian = abs(zone) * 6 - 183
+    offset = max(abs((lon - central_meridian + 180) % 360 - 180) for lon in x)
+    if offset > MAX_UTM_OFFSET:
+        raise ValueError('the area {0} to {1} E, {2} to {3} N lies {4:.0f} degrees '
+                         'from UTM zone {5}{6} of the product crs {7}; give a crs '
+                         'covering it (e.g. EPSG:6372 for Mexico) with --crs or in '
+                         'the product definition'.format(
+                             min(x), max(x), min(y), max(y), offset, abs(zone),
+                             'N' if zone > 0 else 'S', product['crs']))
+
+
+def product_tiles(product, x, y, crs='EPSG:4326'):
+    """
+    List the tiles of the product grid covering an area.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param x: the (min, max) x of the area
+    :param y: the (min, max) y of the area
+    :param crs: the crs of the area
+
+    :returns: a list of (i, j) tile indices; tile (i, j) spans
+              [i, i + 1) * tile width in x and [j, j + 1) * tile height in y
+    :raises ValueError: if the product crs does not suit a latitude/longitude
+                        area, see :func:`check_crs`
+
+    """
+
+    if crs == 'EPSG:4326':
+        check_crs(product, x, y)
+    if Datacube is None:
+        raise ImportError('datacube is required to list tiles')
+    area = geometry.box(min(x), min(y), max(x), max(y), crs=geometry.CRS(crs))
+    bounds = area.to_crs(geometry.CRS(product['crs'])).boundingbox
+    tile_x, tile_y = product['tile_size']
+    return [(i, j)
+            for j in range(int(np.floor(bounds.bottom / tile_y)),
+                           int(np.ceil(bounds.top / tile_y)))
+            for i in range(int(np.floor(bounds.left / tile_x)),
+                           int(np.ceil(bounds.right / tile_x)))]
+
+
+def tile_query(product, tile, time):
+    """
+    Get the datacube query of one tile of the product grid.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param tile: the (i, j) tile index
+    :param time: the (start, end) dates, as 'YYYY-MM-DD' strings
+
+    :returns: the query
+
+    """
+
+    i, j = tile
+    tile_x, tile_y = product['tile_size']
+    return {'x': (i * tile_x, (i + 1) * tile_x),
+            'y': (j * tile_y, (j + 1) * tile_y),
+            'crs': product['crs'], 'output_crs': product['crs'],
+            'resolution': product['resolution'], 'time': time}
+
+
+def write_tile(product, tile, data, filename, band_names, nodata):
+    """
+    Write the bands of one tile to a tiled, compressed GeoTIFF.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param tile: the (i, j) tile index
+    :param data: the bands, (band, y, x)
+    :param filename: the GeoTIFF to write
+    :param band_names: the band descriptions
+    :param nodata: the nodata value
+
+    :returns: the GeoTIFF
+
+    """
+
+    if rasterio is None:
+        raise ImportError('rasterio is required to write tiles')
+
+    i, j = tile
+    tile_x, tile_y = product['tile_size']
+    res_y, res_x = product['resolution']
+    profile = {'driver': 'GTiff', 'dtype': data.dtype.name, 'nodata': nodata,
+               'count': data.shape[0], 'height': data.shape[1],
+               'width': data.shape[2], 'crs': product['crs'],
+               'transform': Affine(res_x, 0, i * tile_x, 0, res_y, (j + 1) * tile_y),
+               'tiled': True, 'compress': 'deflate'}
+    with rasterio.open(filename, 'w', **profile) as dst:
+        dst.write(data)
+        dst.descriptions = tuple(band_names)
+    return filename
+
+
+def compute_tile(product, tile, sensors, time, output_dir, eps=1e-2):
+    """
+    Load, reduce and write one tile; run in a worker process.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param tile: the (i, j) tile index
+    :param sensors: the sensors, e.g. ['ls8', 'ls7']
+    :param time: the (start, end) dates, as 'YYYY-MM-DD' strings
+    :param output_dir: the folder of the output GeoTIFFs
+    :param eps: the convergence threshold in reflectance units
+
+    :returns: the GeoTIFF written, or None if the tile has no data
+
+    """
+
+    if Datacube is None:
+        raise ImportError('datacube is required to compute tiles')
+
+    dc = Datacube(app='geomedian')
+    query = tile_query(product, tile, time)
+    streams = [load_sensor(dc, sensor, product['bands'], query) for sensor in sensors]
+    slices = [np.stack([bands[name] for name in product['bands']])
+              for _, _, bands in merge_sensors(streams)]
+    if not slices:
+        return None
+    result = geomedian_tile(np.stack(slices), product['nodata'], eps)
+    del slices
+
+    filename = os.path.join(output_dir, '{0}_{1}_{2}_{3}.tif'.format(
+        product['name'], tile[0], tile[1], time[0][:4]))
+    return write_tile(product, tile, result, filename, product['bands'],
+                      product['nodata'])
+
+
+def _compute_tile(*args):
+    """
+    Compute one tile in a worker process, reporting rather than raising
+    errors so one bad tile does not stop the others.
+
+    """
+
+    try:
+        return compute_tile(*args), None
+    except Exception:
+        return None, '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                       sys.exc_info()[1])
+
+
+def compute_tiles(product, tiles, sensors, time, output_dir, workers=None,
+                  eps=1e-2):
+    """
+    Compute many tiles concurrently.
+
+    :param product: the product, as returned by :func:`read_product`
+    :param tiles: the (i, j) tile indices
+    :param sensors: the sensors, e.g. ['ls8', 'ls7']
+    :param time: the (start, end) dates, as 'YYYY-MM-DD' strings
+    :param output_dir: the folder of the output GeoTIFFs
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+    :param eps: the convergence threshold in reflectance units
+
+    :returns: a list of the tiles that could not be computed
+
+    """
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_compute_tile, product, tile, sensors,
+                                        time, output_dir, eps), tile)
+                       for tile in tiles)
+        for future in as_completed(futures):
+            tile = futures[future]
+            filename, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping tile: {0}'.format(tile))
+                failed.append(tile)
+            elif filename is None:
+                print('tile {0} has no data'.format(tile))
+            else:
+                print('tile {0} complete'.format(filename))
+    return failed
+
+
+def geomedian():
+    parser = argparse.ArgumentParser(
+        description='Compute the annual geomedian of Landsat Level-2 scenes, tile by tile.')
+    parser.add_argument('output_dir', help='folder of the output GeoTIFFs')
+    parser.add_argument('--x', type=float, nargs=2, required=True,
+                        help='longitude range of the area')
+    parser.add_argument('--y', type=float, nargs=2, required=True,
+                        help='latitude range of the area')
+    parser.add_argument('--year', type=int, required=True, help='year to summarise')
+    parser.add_argument('--sensors', nargs='+', default=['ls8', 'ls7', 'ls5'],
+                        help='sensors to use (default: ls8 ls7 ls5)')
+    parser.add_argument('--product', default=PRODUCT_YAML,
+                        help='product definition (default: geomedian/geomed_product.yaml)')
+    parser.add_argument('--crs', default=None,
+                        help='crs of the output grid, e.g. EPSG:6372 (default: that of the product)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tiles computed in parallel (default: number of CPUs)')
+    parser.add_argument('--eps', type=float, default=1e-2,
+                        help='convergence threshold in reflectance units (default: 0.01)')
+    args = parser.parse_args()
+
+    product = read_product(args.product)
+    if args.crs:
+        product['crs'] = args.crs
+    tiles = product_tiles(product, args.x, args.y)
+    time = ('{0}-01-01'.format(args.year), '{0}-12-31'.format(args.year))
+    print('computing {0} tile(s) of {1} for {2}'.format(len(tiles), product['name'], args.year))
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    compute_tiles(product, tiles, args.sensors, time, args.output_dir,
+                  args.workers, args.eps)
+
+
+if __name__ == '__main__':
+    geomedian()
@@ -0,0 +1,186 @@
+"""
+:mod:`index_reducers` - Single-pass per-pixel statistics of band ratio
+indices.
+===============================================================================
+
+``StatsApp`` and ``max_ndvi.ipynb`` compute NDVI for the whole stack before
+summarising it over time, holding pixels x time floats. The reducers here
+compute an index one acquisition at a time and fold it into running
+statistics, so their memory is a few arrays the size of one time slice,
+however long the period. They follow the reducer protocol of
+:mod:`tile_loader`.
+
+Percentiles come from a per-pixel histogram over the index range. They are
+the smallest value with at least q % of the values at or below it (numpy's
+``inverted_cdf`` method), to within one bin width (0.03 with the default 64
+bins over [-1, 1]). The histogram costs one byte per bin and pixel (two
+beyond 255 time slices), 64 bytes with the default bins, whatever the
+period; a float32 stack costs 4 bytes per acquisition and pixel, so
+above 16 acquisitions (a year of one sensor has about 23) the histogram is
+the smaller. More bins buy precision at the cost of that margin.
+
+"""
+
+import numpy as np
+
+NODATA = -9999
+
+# histogram bins of the percentiles, see the module docstring
+PERCENTILE_BINS = 64
+
+# normalised difference indices, (a - b) / (a + b), by name
+INDICES = {'ndvi': ('nir', 'red'),
+           'ndwi': ('green', 'nir'),
+           'mndwi': ('green', 'swir1'),
+           'ndmi': ('nir', 'swir1'),
+           'nbr': ('nir', 'swir2')}
+
+
+def normalised_difference(a, b, nodata=NODATA):
+    """
+    Calculates a normalized ratio index of two int16 bands, NaN where either
+    band is nodata or both are zero.
+
+    :param a: the first band
+    :param b: the second band
+    :param nodata: the nodata value of the bands
+
+    :returns: a float32 array
+
+    """
+
+    a = a.astype(np.float32)
+    b = b.astype(np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (a - b) / (a + b)
+    ratio[(a == nodata) | (b == nodata) | ~np.isfinite(ratio)] = np.nan
+    return ratio
+
+
+class IndexStatistics(object):
+    """
+    Running count, minimum, maximum, mean and optionally percentiles of an
+    index for every pixel.
+
+    :param index: the name of an index in :data:`INDICES`, or a callable
+                  taking the bands of a time slice and returning the index,
+                  NaN where unknown
+    :param percentiles: the percentiles wanted, e.g. (10, 50, 90)
+    :param bins: the number of histogram bins of the percentiles, one byte
+                 per pixel each
+    :param value_range: the (lowest, highest) value of the histogram; values
+                        outside fall into the end bins
+    :param nodata: the nodata value of the bands
+
+    """
+
+    def __init__(self, index='ndvi', percentiles=(), bins=PERCENTILE_BINS,
+                 value_range=(-1, 1), nodata=NODATA):
+        self.index = index
+        self.percentiles = tuple(percentiles)
+        self.bins = bins
+        self.value_range = value_range
+        self.nodata = nodata
+        self.count = None
+
+    def _compute(self, bands):
+        if callable(self.index):
+            return self.index(bands)
+        a, b = INDICES[self.index]
+        return normalised_difference(bands[a], bands[b], self.nodata)
+
+    def _start(self, shape):
+        self.count = np.zeros(shape, dtype=np.uint32)
+        self.total = np.zeros(shape, dtype=np.float64)
+        self.minimum = np.full(shape, np.nan, dtype=np.float32)
+        self.maximum = np.full(shape, np.nan, dtype=np.float32)
+        self.slices = 0
+        # uint8 counts, widened when a pixel could exceed them
+        self.histogram = np.zeros((self.bins,) + shape, dtype=np.uint8) \
+            if self.percentiles else None
+
+    def update(self, time, bands):
+        """
+        Fold the index of one time slice into the statistics.
+
+        :param time: the time of the slice
+        :param bands: the cloud masked bands of the slice, (y, x) arrays
+                      keyed by name
+
+        """
+
+        value = self._compute(bands)
+        if self.count is None:
+            self._start(value.shape)
+
+        valid = ~np.isnan(value)
+        self.count += valid
+        self.total += np.where(valid, value, 0)
+        # fmin and fmax ignore the NaNs on either side
+        np.fmin(self.minimum, value, out=self.minimum)
+        np.fmax(self.maximum, value, out=self.maximum)
+
+        if self.histogram is not None:
+            self.slices += 1
+            if self.slices > np.iinfo(self.histogram.dtype).max:
+                self.histogram = self.histogram.astype(np.uint16)
+            low, high = self.value_range
+            bin_index = ((value[valid] - low) * (self.bins / float(high - low))).astype(np.intp)
+            bin_index.clip(0, self.bins - 1, out=bin_index)
+            # each pixel is counted once per slice, so no index repeats
+            pixels = np.flatnonzero(valid)
+            self.histogram.reshape(self.bins, -1)[bin_index, pixels] += 1
+
+    def _percentile(self, q):
+        low, high = self.value_range
+        width = (high - low) / float(self.bins)
+        cumulative = np.cumsum(self.histogram, axis=0, dtype=np.uint32)
+        target = self.count * (q / 100.)
+        bin_index = np.minimum((cumulative < target).sum(axis=0), self.bins - 1)
+        below = np.where(bin_index > 0,
+                         np.take_along_axis(cumulative, np.maximum(bin_index - 1, 0)[np.newaxis],
+                                            axis=0)[0], 0)
+        in_bin = np.take_along_axis(self.histogram, bin_index[np.newaxis], axis=0)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.clip((target - below) / in_bin, 0, 1)
+        value = low + (bin_index + fraction) * width
+        # the end bins hold values out of range; the extremes are exact
+        value = np.clip(value, self.minimum, self.maximum)
+        value[self.count == 0] = np.nan
+        return value.astype(np.float32)
+
+    def result(self):
+        """
+        :returns: the statistics keyed by name ('count', 'min', 'max', 'mean'
+                  and 'p<q>' for each percentile), NaN where a pixel has no
+                  valid value; None if no time slice was seen
+
+        """
+
+        if self.count is None:
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (self.total / self.count).astype(np.float32)
+        result = {'count': self.count, 'min': self.minimum,
+                  'max': self.maximum, 'mean': mean}
+        for q in self.percentiles:
+            result['p{0:g}'.format(q)] = self._percentile(q)
+        return result
+
+
+def index_statistics(indices=('ndvi',), percentiles=(), bins=PERCENTILE_BINS):
+    """
+    Make fresh reducers of several indices, e.g. as the ``make_reducers`` of
+    :func:`tile_loader.reduce_tiles`
+    (``partial(index_statistics, ('ndvi', 'ndwi'))``).
+
+    :param indices: the names of the indices
+    :param percentiles: the percentiles wanted of each index
+    :param bins: the number of histogram bins of the percentiles
+
+    :returns: :class:`IndexStatistics` reducers keyed by index name
+
+    """
+
+    return dict((index, IndexStatistics(index, percentiles, bins))
+                for index in indices)
@@ -0,0 +1,250 @@
+"""
+:mod:`pq_mask` - Cloud masking of USGS Level-2 stacks with ``pixel_qa``.
+===============================================================================
+
+``masking.make_mask`` followed by ``Dataset.where`` turns every int16 band
+into float64 with NaNs, four times the memory of the data. Here ``pixel_qa``
+is decoded with a lookup table holding the answer for every possible 16 bit
+value, the mask is kept bit-packed (one bit per pixel) and applied in place,
+so the bands stay int16 with the product's -9999 nodata.
+
+Bits of ``pixel_qa`` (Landsat Collection 1 Level-2):
+
+=== ============
+bit flag
+=== ============
+0   fill
+1   clear
+2   water
+3   cloud_shadow
+4   snow
+5   cloud
+=== ============
+
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+from download_modules import tiff_band
+
+NODATA = -9999
+
+# the pixel_qa bits, and the mask of load_combine_mask_discard in the
+# notebooks (whose mask_invalid_data also drops the fill pixels), as decoded
+# by the download scripts
+PQ_BITS = tiff_band.PQ_BITS
+CLOUD_FREE = tiff_band.CLOUD_FREE
+
+# number of set bits of every byte value
+_BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None],
+                            axis=1).sum(axis=1)
+
+
+@lru_cache(maxsize=None)
+def _lookup_table(flags):
+    table = tiff_band.flag_table(**dict(flags))
+    table.flags.writeable = False
+    return table
+
+
+def lookup_table(**flags):
+    """
+    Get the lookup table answering, for every 16 bit ``pixel_qa`` value,
+    whether it matches the flags. Tables are built once and cached.
+
+    :param flags: the wanted state of each flag, e.g. ``cloud=False``
+
+    :returns: a read-only boolean array of 65536 entries
+    :raises KeyError: for an unknown flag
+
+    """
+
+    for flag in flags:
+        if flag not in PQ_BITS:
+            raise KeyError('unknown pixel_qa flag {0}'.format(flag))
+    return _lookup_table(tuple(sorted((flag, bool(wanted))
+                                      for flag, wanted in flags.items())))
+
+
+def make_mask(pixel_qa, **flags):
+    """
+    Decode ``pixel_qa`` into a boolean mask, True where the pixel matches the
+    flags.
+
+    :param pixel_qa: the ``pixel_qa`` band, any shape, of an integer type
+    :param flags: the wanted state of each flag, defaults to :data:`CLOUD_FREE`
+
+    :returns: a boolean array the shape of ``pixel_qa``
+    :raises ValueError: if ``pixel_qa`` is not integer, e.g. float64 after
+                        ``masking.mask_invalid_data``, or holds values out of
+                        the 16 bit range
+
+    """
+
+    table = lookup_table(**(flags or CLOUD_FREE))
+    pixel_qa = np.asarray(pixel_qa)
+    if pixel_qa.dtype.kind not in 'iu':
+        raise ValueError('pixel_qa must be an integer array, not {0}; decode it '
+                         'before masking.mask_invalid_data'.format(pixel_qa.dtype))
+    if pixel_qa.dtype.itemsize == 2 and pixel_qa.dtype.isnative:
+        # int16 loads of pixel_qa are reinterpreted, not converted
+        return table[pixel_qa.view(np.uint16)]
+    if pixel_qa.size and (pixel_qa.min() < -2 ** 15 or pixel_qa.max() >= 2 ** 16):
+        raise ValueError('pixel_qa values must fit in 16 bits')
+    return table[pixel_qa.astype(np.uint16)]
+
+
+def pack_mask(mask):
+    """
+    Pack a boolean mask to one bit per pixel along its last axis.
+
+    :param mask: a boolean array
+
+    :returns: the packed mask, a uint8 array
+
+    """
+
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, width):
+    """
+    Unpack a mask packed by :func:`pack_mask`.
+
+    :param packed: the packed mask
+    :param width: the length of the last axis of the original mask
+
+    :returns: a boolean array
+
+    """
+
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
+
+
+def make_packed_mask(pixel_qa, **flags):
+    """
+    Decode a ``pixel_qa`` stack into a packed mask one time slice at a time,
+    so the full size boolean mask is never held in memory.
+
+    :param pixel_qa: the ``pixel_qa`` stack, (time, y, x)
+    :param flags: the wanted state of each flag, defaults to :data:`CLOUD_FREE`
+
+    :returns: the packed mask, (time, y, ceil(x / 8)) uint8
+
+    """
+
+    pixel_qa = np.asarray(pixel_qa)
+    packed = np.empty(pixel_qa.shape[:-1] + ((pixel_qa.shape[-1] + 7) // 8,),
+                      dtype=np.uint8)
+    for t in range(pixel_qa.shape[0]):
+        packed[t] = pack_mask(make_mask(pixel_qa[t], **flags))
+    return packed
+
+
+def apply_mask(data, packed, nodata=NODATA):
+    """
+    Set the pixels of a stack outside a packed mask to nodata, in place and
+    one time slice at a time.
+
+    :param data: the stack, (time, y, x), keeps its dtype
+    :param packed: the packed mask from :func:`make_packed_mask`
+    :param nodata: the nodata value
+
+    :returns: the stack
+
+    """
+
+    width = data.shape[-1]
+    for t in range(data.shape[0]):
+        np.copyto(data[t], nodata, where=~unpack_mask(packed[t], width))
+    return data
+
+
+def clear_fraction(packed, width):
+    """
+    Get the fraction of pixels inside a packed mask for every time slice.
+
+    :param packed: the packed mask from :func:`make_packed_mask`
+    :param width: the length of the x axis of the stack
+
+    :returns: a float array, one value per time slice
+
+    """
+
+    # the padding bits of each packed row are zero
+    counts = _BIT_COUNTS[packed].reshape(len(packed), -1).sum(axis=1)
+    return counts / float(np.prod(packed.shape[1:-1]) * width)
+
+
+def mask_stack(bands, pixel_qa, cloud_free_threshold=0, nodata=NODATA,
+               **flags):
+    """
+    Mask a stack of bands with its ``pixel_qa``, keeping them int16, and
+    find the time slices with at least ``cloud_free_threshold`` clear pixels.
+
+    :param bands: the int16 bands, (time, y, x) arrays keyed by name, masked
+                  in place
+    :param pixel_qa: the ``pixel_qa`` stack, (time, y, x)
+    :param cloud_free_threshold: the least fraction of clear pixels of a time
+                                 slice worth keeping
+    :param nodata: the nodata value
+    :param flags: the wanted state of each flag, defaults to :data:`CLOUD_FREE`
+
+    :returns: a boolean array selecting the time slices to keep
+
+    """
+
+    packed = make_packed_mask(pixel_qa, **flags)
+    for data in bands.values():
+        apply_mask(data, packed, nodata)
+    return clear_fraction(packed, np.shape(pixel_qa)[-1]) >= cloud_free_threshold
+
+
+def mask_dataset(ds, cloud_free_threshold=0, nodata=NODATA, **flags):
+    """
+    Cloud mask an ``xarray.Dataset`` loaded from a ``*_usgs_sr_scene``
+    product, a drop-in for the masking in the notebooks'
+    ``load_combine_mask_discard`` that keeps the bands int16.
+
+    Numpy-backed bands are masked in place. Dask-backed bands (loads with
+    ``dask_chunks``) are masked lazily with ``where``, a chunk at a time;
+    only the clear fraction of each time slice is computed.
+
+    :param ds: the dataset, with a ``pixel_qa`` variable
+    :param cloud_free_threshold: the least fraction of clear pixels of a time
+                                 slice worth keeping
+    :param nodata: the nodata value
+    :param flags: the wanted state of each flag, defaults to :data:`CLOUD_FREE`
+
+    :returns: the masked dataset, without ``pixel_qa`` and without the time
+              slices below the threshold
+
+    """
+
+    if ds.pixel_qa.chunks is not None or \
+            any(ds[name].chunks is not None for name in ds.data_vars):
+        if xr is None:
+            raise ImportError('xarray is required to mask dask-backed datasets')
+        mask = xr.apply_ufunc(make_mask, ds.pixel_qa, kwargs=flags,
+                              dask='parallelized', output_dtypes=[bool])
+        keep = mask.mean(dim=[dim for dim in mask.dims if dim != 'time']).values \
+            >= cloud_free_threshold
+        masked = ds.drop_vars('pixel_qa').where(mask, nodata)
+        return masked.isel(time=np.flatnonzero(keep))
+
+    bands = dict((name, ds[name].values) for name in ds.data_vars
+                 if name != 'pixel_qa')
+    keep = mask_stack(bands, ds.pixel_qa.values, cloud_free_threshold, nodata,
+                      **flags)
+    # .values is the data itself for numpy-backed variables; assigning it
+    # back also covers backends where it is a copy
+    masked = ds.drop_vars('pixel_qa').assign(
+        **dict((name, ds[name].copy(data=data)) for name, data in bands.items()))
+    return masked.isel(time=np.flatnonzero(keep))
@@ -0,0 +1,202 @@
+#!/bin/env python
+"""
+:mod:`scene_reader` - Memory-mapped access to the bands of unpacked scenes.
+===============================================================================
+
+The ESPA GeoTIFFs (``sr_band*``, ``pixel_qa``, ...) are uncompressed and
+stored in strips, one after the other, so each band is a plain array at some
+offset in its file. Only the TIFF header and first IFD are parsed (by
+``download_script/tiff_band.py``, no GDAL); the pixels are then mapped with
+:class:`numpy.memmap` and windows are views of the mapping, read from disk by
+the page cache as they are touched. This is enough for quick QA of freshly unpacked scenes
+without indexing them into a datacube first.
+
+Compressed or tiled GeoTIFFs, e.g. scenes converted by :mod:`cog_scenes`,
+cannot be mapped and are refused.
+
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from download_modules import tiff_band
+
+# the band reader and summaries are shared with the sidecars written while
+# unpacking, see download_script/tiff_band.py
+read_ifd = tiff_band.read_ifd
+TiffBand = tiff_band.TiffBand
+pixel_qa_summary = tiff_band.pixel_qa_summary
+band_statistics = tiff_band.band_statistics
+SUMMARY_FLAGS = tiff_band.SUMMARY_FLAGS
+
+
+class Scene(object):
+    """
+    The memory-mapped bands of an unpacked scene, keyed by their ESPA name
+    (e.g. 'sr_band1', 'pixel_qa').
+
+    :param scene_folder: the scene folder, as made by :mod:`unpack_scenes`
+
+    :raises ValueError: if the scene has no bands, if a band cannot be mapped
+                        or if the bands differ in size
+
+    """
+
+    def __init__(self, scene_folder):
+        self.folder = scene_folder
+        self.name = os.path.basename(os.path.normpath(scene_folder))
+        self.bands = {}
+        for path in sorted(glob.glob(os.path.join(scene_folder, self.name + '_*.tif'))):
+            band = os.path.splitext(os.path.basename(path))[0][len(self.name) + 1:]
+            self.bands[band] = TiffBand(path)
+        if not self.bands:
+            raise ValueError('no bands in scene folder {0}'.format(scene_folder))
+        if len(set(band.shape for band in self.bands.values())) > 1:
+            raise ValueError('the bands of scene {0} differ in size'.format(self.name))
+
+    @property
+    def shape(self):
+        return next(iter(self.bands.values())).shape
+
+    def window(self, row, col, height, width, bands=None):
+        """
+        Get the same window of several bands, without reading them.
+
+        :param row: the first row
+        :param col: the first column
+        :param height: the number of rows
+        :param width: the number of columns
+        :param bands: the band names, None for all
+
+        :returns: read-only (height, width) views keyed by band name
+
+        """
+
+        return dict((name, self.bands[name].window(row, col, height, width))
+                    for name in (bands or self.bands))
+
+    def blocks(self, block_rows=1024, bands=None):
+        """
+        Walk the bands in blocks of whole rows, the order they are stored in.
+
+        :param block_rows: the number of rows of a block
+        :param bands: the band names, None for all
+
+        :returns: a generator of (row, views) tuples, ``views`` as returned by
+                  :meth:`window`
+
+        """
+
+        height, width = self.shape
+        for row in range(0, height, block_rows):
+            yield row, self.window(row, 0, min(block_rows, height - row), width, bands)
+
+    def preview(self, band, step=16):
+        """
+        Get a decimated view of a band, every ``step``-th pixel of every
+        ``step``-th row.
+
+        :param band: the band name
+        :param step: the decimation factor
+
+        :returns: a read-only strided view of the mapped band
+
+        """
+
+        return self.bands[band].array[::step, ::step]
+
+
+def scene_summary(scene_folder, block_rows=1024):
+    """
+    Count the pixels of a scene by ``pixel_qa`` flag.
+
+    :param scene_folder: the scene folder
+    :param block_rows: the number of rows read at a time
+
+    :returns: a dictionary with the scene name and the counts and fractions
+              of :func:`pixel_qa_summary`
+    :raises ValueError: if the scene has no ``pixel_qa`` band
+
+    """
+
+    scene = Scene(scene_folder)
+    if 'pixel_qa' not in scene.bands:
+        raise ValueError('scene {0} has no pixel_qa band'.format(scene.name))
+
+    summary = {'scene': scene.name}
+    summary.update(pixel_qa_summary(scene.bands['pixel_qa'], block_rows))
+    return summary
+
+
+def _scene_summary(scene_folder, block_rows):
+    """
+    Summarise one scene in a worker process, reporting rather than raising
+    errors so one bad scene does not stop the others.
+
+    """
+
+    try:
+        return scene_summary(scene_folder, block_rows), None
+    except Exception:
+        return None, '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                       sys.exc_info()[1])
+
+
+def summarise_all(scene_folders, output_csv, workers=None, block_rows=1024):
+    """
+    Summarise many scenes concurrently into a CSV file, a row per scene.
+
+    :param scene_folders: a list of unpacked scene folders
+    :param output_csv: the CSV file to write
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+    :param block_rows: the number of rows read at a time
+
+    :returns: a list of the scene folders that could not be summarised
+
+    """
+
+    columns = ['scene', 'pixels', 'valid'] + \
+        [name + '_fraction' for name in sorted(SUMMARY_FLAGS) if name != 'valid']
+    failed = []
+    with open(output_csv, 'w', newline='') as f, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        futures = dict((executor.submit(_scene_summary, scene_folder, block_rows),
+                        scene_folder)
+                       for scene_folder in scene_folders)
+        for future in as_completed(futures):
+            scene_folder = futures[future]
+            summary, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping: ' + scene_folder)
+                failed.append(scene_folder)
+            else:
+                writer.writerow(summary)
+    return failed
+
+
+def scene_reader():
+    parser = argparse.ArgumentParser(
+        description='Summarise the pixel_qa of unpacked USGS Landsat scenes.')
+    parser.add_argument('target_folder', help='path to your ungzipped/untarred USGS Landsat scenes')
+    parser.add_argument('output_csv', help='CSV file of the summaries, a row per scene')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of scenes read in parallel (default: number of CPUs)')
+    parser.add_argument('--block-rows', type=int, default=1024,
+                        help='rows read at a time (default: 1024)')
+    args = parser.parse_args()
+    scene_folders = glob.glob(args.target_folder + '/*/*/')  # path/row/scene folders
+    failed = summarise_all(scene_folders, args.output_csv, args.workers, args.block_rows)
+    print('{0} scene(s) summarised, {1} failed'.format(len(scene_folders) - len(failed),
+                                                       len(failed)))
+
+
+if __name__ == '__main__':
+    scene_reader()
@@ -0,0 +1,206 @@
+"""
+:mod:`tile_loader` - Stream multi-decade, multi-sensor time series in
+spatial tiles.
+===============================================================================
+
+``load_combine_mask_discard`` in the notebooks loads every sensor for the
+whole area and period at once, then ``xr.concat`` and ``sortby('time')`` copy
+it all twice more. Here the area is cut into tiles on the output pixel grid,
+each sensor is loaded one time window at a time and masked with
+:mod:`pq_mask` (staying int16), and the sensors are merged by time with a
+k-way merge of their already sorted streams. Reducers see one time slice at a
+time, so memory is bounded by a tile and a time window per sensor, not by the
+length of the time series.
+
+A reducer is any object with ``update(time, bands)``, called with each time
+slice in time order (``bands`` maps band names to 2D int16 arrays with
+-9999 nodata where masked), and ``result()``, called once the tile is done.
+
+"""
+
+import heapq
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from operator import itemgetter
+
+import numpy as np
+from datacube.utils import geometry
+
+from pq_mask import mask_stack
+
+# pixel offsets and size of a tile in the output grid, and its datacube query
+Tile = namedtuple('Tile', ['row', 'col', 'height', 'width', 'query'])
+
+
+def tiles(query, tile_size=512):
+    """
+    Cut the area of a datacube query into tiles of the output pixel grid.
+    Tile edges fall on pixel edges, so the tiles load exactly the pixels of
+    the whole area, without gaps or overlaps.
+
+    :param query: a datacube query with ``x``, ``y``, ``crs``, ``output_crs``
+                  and ``resolution``, as in the notebooks
+    :param tile_size: the width and height of a tile in pixels
+
+    :returns: a list of :class:`Tile`, row by row from the top left
+    :raises ValueError: if the query has no output grid
+
+    """
+
+    if 'output_crs' not in query or 'resolution' not in query:
+        raise ValueError('tiling a query needs its output_crs and resolution')
+
+    res_y, res_x = abs(query['resolution'][0]), abs(query['resolution'][1])
+    area = geometry.box(min(query['x']), min(query['y']),
+                        max(query['x']), max(query['y']),
+                        crs=geometry.CRS(query.get('crs', query['output_crs'])))
+    bounds = area.to_crs(geometry.CRS(query['output_crs'])).boundingbox
+
+    left = float(np.floor(bounds.left / res_x) * res_x)
+    top = float(np.ceil(bounds.top / res_y) * res_y)
+    width = int(np.ceil(bounds.right / res_x) - np.floor(bounds.left / res_x))
+    height = int(np.ceil(bounds.top / res_y) - np.floor(bounds.bottom / res_y))
+
+    result = []
+    for row in range(0, height, tile_size):
+        tile_height = min(tile_size, height - row)
+        for col in range(0, width, tile_size):
+            tile_width = min(tile_size, width - col)
+            tile_query = dict(query,
+                              x=(left + col * res_x,
+                                 left + (col + tile_width) * res_x),
+                              y=(top - (row + tile_height) * res_y,
+                                 top - row * res_y),
+                              crs=query['output_crs'])
+            result.append(Tile(row, col, tile_height, tile_width, tile_query))
+    return result
+
+
+def time_windows(time_range, years=1):
+    """
+    Split a time range into consecutive windows.
+
+    :param time_range: the (start, end) dates, as 'YYYY-MM-DD' strings
+    :param years: the length of a window in years
+
+    :returns: a list of (start, end) date strings, both ends included
+
+    """
+
+    start, end = [datetime.strptime(day, '%Y-%m-%d').date() for day in time_range]
+    windows = []
+    while start <= end:
+        next_start = date(start.year + years, 1, 1)
+        windows.append((start.isoformat(),
+                        min(end, next_start - timedelta(days=1)).isoformat()))
+        start = next_start
+    return windows
+
+
+def load_sensor(dc, sensor, measurements, query, years=1,
+                cloud_free_threshold=0):
+    """
+    Stream the cloud masked time slices of one sensor, a time window at a
+    time.
+
+    :param dc: a :class:`datacube.Datacube`
+    :param sensor: the sensor, e.g. 'ls8', loaded from its ``_usgs_sr_scene``
+                   product
+    :param measurements: the bands to load; ``pixel_qa`` is always loaded
+    :param query: the datacube query, usually of one tile
+    :param years: the length of a time window in years
+    :param cloud_free_threshold: the least fraction of clear pixels of a time
+                                 slice worth keeping
+
+    :returns: a generator of (time, sensor, bands) tuples in time order,
+              ``bands`` mapping band names to int16 (y, x) arrays
+
+    """
+
+    measurements = [name for name in measurements if name != 'pixel_qa'] + ['pixel_qa']
+    for start, end in time_windows(query['time'], years):
+        ds = dc.load(product=sensor + '_usgs_sr_scene', measurements=measurements,
+                     group_by='solar_day', **dict(query, time=(start, end)))
+        if not ds.data_vars:
+            continue
+
+        # masked and yielded as the numpy arrays of .values, never through
+        # ds, so dask-backed loads are masked too
+        bands = dict((name, ds[name].values) for name in ds.data_vars
+                     if name != 'pixel_qa')
+        keep = mask_stack(bands, ds.pixel_qa.values, cloud_free_threshold)
+        times = ds.time.values
+        del ds
+        for t in np.flatnonzero(keep):
+            yield times[t], sensor, dict((name, band[t])
+                                         for name, band in bands.items())
+
+
+def merge_sensors(streams):
+    """
+    Merge the time sorted streams of several sensors into one, by time.
+
+    :param streams: generators as returned by :func:`load_sensor`
+
+    :returns: a generator of (time, sensor, bands) tuples in time order
+
+    """
+
+    return heapq.merge(*streams, key=itemgetter(0))
+
+
+def reduce_tiles(dc, sensors, measurements, query, make_reducers,
+                 tile_size=512, years=1, cloud_free_threshold=0):
+    """
+    Run reducers over the merged time series of every tile of a query.
+
+    :param dc: a :class:`datacube.Datacube`
+    :param sensors: the sensors, e.g. ['ls8', 'ls7', 'ls5']
+    :param measurements: the bands to load
+    :param query: the datacube query of the whole area and period
+    :param make_reducers: a callable returning fresh reducers keyed by name,
+                          called once per tile
+    :param tile_size: the width and height of a tile in pixels
+    :param years: the length of a time window in years
+    :param cloud_free_threshold: the least fraction of clear pixels of a time
+                                 slice worth keeping
+
+    :returns: a generator of (tile, results) tuples, ``results`` mapping the
+              reducer names to their results
+
+    """
+
+    for tile in tiles(query, tile_size):
+        reducers = make_reducers()
+        streams = [load_sensor(dc, sensor, measurements, tile.query, years,
+                               cloud_free_threshold)
+                   for sensor in sensors]
+        for time, sensor, bands in merge_sensors(streams):
+            for reducer in reducers.values():
+                reducer.update(time, bands)
+        yield tile, dict((name, reducer.result())
+                         for name, reducer in reducers.items())
+
+
+def mosaic(tile_results, name, dtype=np.float64, fill=np.nan):
+    """
+    Put the results of one reducer over all tiles back together.
+
+    :param tile_results: the (tile, results) tuples of :func:`reduce_tiles`
+    :param name: the reducer name
+    :param dtype: the data type of the mosaic
+    :param fill: the value of tiles without a result
+
+    :returns: a (y, x) array of the whole area
+
+    """
+
+    tile_results = list(tile_results)
+    height = max(tile.row + tile.height for tile, results in tile_results)
+    width = max(tile.col + tile.width for tile, results in tile_results)
+    out = np.full((height, width), fill, dtype=dtype)
+    for tile, results in tile_results:
+        if results.get(name) is not None:
+            out[tile.row:tile.row + tile.height,
+                tile.col:tile.col + tile.width] = results[name]
+    return out
@@ -0,0 +1,489 @@
+#!/bin/env python
+"""
+:mod:`tile_scheduler` - Batch statistics over every tile of the national
+product grid.
+===============================================================================
+
+Tiles of the product grid (``tile_size`` and ``crs`` of
+``geomedian/geomed_product.yaml``) are enumerated over the footprints of the
+path/rows of ``level2_order_download.cfg``, as recorded in the catalogue, and
+queued as one job per tile in a work queue on disk::
+
+    queue/todo/      jobs waiting
+    queue/running/   jobs claimed by a worker
+    queue/done/      jobs completed
+    queue/failed/    jobs that raised, with the error in <job>.err
+
+A worker claims a job by renaming it from ``todo`` to ``running``; the rename
+is atomic, so any number of workers, in a local process pool or on several
+nodes sharing the queue folder, never run the same tile twice. Failed jobs,
+and jobs left running by a worker that died, are put back with ``retry``.
+
+"""
+
+import argparse
+import configparser
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from geomedian import (PRODUCT_YAML, compute_tile, product_tiles, read_product,
+                       tile_query, write_tile)
+from index_reducers import INDICES, index_statistics
+
+try:
+    from datacube import Datacube
+    from tile_loader import load_sensor, merge_sensors
+except ImportError:
+    Datacube = None
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'download_script', 'level2_order_download.cfg')
+
+STATES = ('todo', 'running', 'done', 'failed')
+
+
+class TileQueue(object):
+    """
+    Work queue of tile jobs kept as JSON files in a folder per state.
+
+    :param queue_dir: the queue folder, created if missing
+
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for state in STATES:
+            if not os.path.isdir(os.path.join(queue_dir, state)):
+                os.makedirs(os.path.join(queue_dir, state))
+
+    def _path(self, state, name):
+        return os.path.join(self.queue_dir, state, name)
+
+    def jobs(self, state):
+        """
+        List the jobs in a state.
+
+        :param state: one of 'todo', 'running', 'done' and 'failed'
+
+        :returns: a sorted list of job names
+
+        """
+
+        return sorted(name for name in os.listdir(os.path.join(self.queue_dir, state))
+                      if name.endswith('.json'))
+
+    def add(self, name, spec):
+        """
+        Queue a job, unless a job of that name is queued in any state.
+
+        :param name: the job name, ending in .json
+        :param spec: the job, a JSON serialisable dictionary
+
+        :returns: True if the job was queued
+
+        """
+
+        if any(os.path.exists(self._path(state, name)) for state in STATES):
+            return False
+        tmp_path = os.path.join(self.queue_dir, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(spec, f, indent=4)
+        # appears in todo complete or not at all
+        os.rename(tmp_path, self._path('todo', name))
+        return True
+
+    def claim(self):
+        """
+        Take the next waiting job.
+
+        :returns: the job name and job, or None if no job is waiting
+
+        """
+
+        for name in self.jobs('todo'):
+            try:
+                # the claim time, for finding the jobs of dead workers; set
+                # before the rename so a running job never shows the age of
+                # its planning to retry
+                os.utime(self._path('todo', name), None)
+                os.rename(self._path('todo', name), self._path('running', name))
+            except OSError:
+                continue  # claimed by another worker
+            with open(self._path('running', name)) as f:
+                return name, json.load(f)
+        return None
+
+    def complete(self, name):
+        """
+        Mark a claimed job as done. A job that ran past ``retry
+        --stale-after`` and was queued again is taken back out of ``todo``,
+        unless another worker has claimed it meanwhile.
+
+        :param name: the job name
+
+        :returns: False if the job was no longer found running or waiting
+
+        """
+
+        for state in ('running', 'todo'):
+            try:
+                os.rename(self._path(state, name), self._path('done', name))
+                return True
+            except OSError:
+                continue
+        return False
+
+    def fail(self, name, error):
+        """
+        Mark a claimed job as failed.
+
+        :param name: the job name
+        :param error: the error message
+
+        :returns: False if the job was no longer running, having been queued
+                  again by ``retry --stale-after``
+
+        """
+
+        error_path = self._path('failed', name[:-len('.json')] + '.err')
+        with open(error_path, 'w') as f:
+            f.write(error + '\n')
+        try:
+            os.rename(self._path('running', name), self._path('failed', name))
+        except OSError:
+            os.remove(error_path)
+            return False
+        return True
+
+    def retry(self, stale_after=None):
+        """
+        Put failed jobs back in the queue, and optionally the jobs claimed
+        longer ago than a worker could take.
+
+        :param stale_after: the age in seconds beyond which a running job is
+                            taken to belong to a dead worker, None to leave
+                            running jobs alone
+
+        :returns: the number of jobs queued again
+
+        """
+
+        count = 0
+        for name in self.jobs('failed'):
+            os.rename(self._path('failed', name), self._path('todo', name))
+            error_path = self._path('failed', name[:-len('.json')] + '.err')
+            if os.path.exists(error_path):
+                os.remove(error_path)
+            count += 1
+        if stale_after is not None:
+            for name in self.jobs('running'):
+                try:
+                    if time.time() - os.path.getmtime(self._path('running', name)) > stale_after:
+                        os.rename(self._path('running', name), self._path('todo', name))
+                        count += 1
+                except OSError:
+                    continue  # finished meanwhile
+        return count
+
+    def counts(self):
+        """
+        :returns: the number of jobs keyed by state
+
+        """
+
+        return dict((state, len(self.jobs(state))) for state in STATES)
+
+
+def path_row_bounds(product_id_path, path_rows):
+    """
+    Get the latitude/longitude bounding box of each path/row, the union of
+    the footprints of its catalogued scenes. They are read from the SQLite
+    index that ``level2_order_download.py`` keeps next to the product id file
+    (``<product id file>.db``, see ``download_script/catalogue.py``).
+
+    :param product_id_path: the product id file
+    :param path_rows: a list of path/rows, e.g. ['018045', '018046']
+
+    :returns: (min lon, min lat, max lon, max lat) keyed by path/row; path/rows
+              without a scene footprint in the catalogue are left out
+    :raises ValueError: if the index is missing or has no footprints
+
+    """
+
+    index_path = os.path.splitext(product_id_path)[0] + '.db'
+    if not os.path.isfile(index_path):
+        raise ValueError('no catalogue index {0}; run level2_order_download.py '
+                         'to build it'.format(index_path))
+    if os.path.isfile(product_id_path) and \
+            os.path.getmtime(index_path) < os.path.getmtime(product_id_path):
+        print('catalogue index {0} is older than {1}; run '
+              'level2_order_download.py to update it'.format(index_path, product_id_path))
+    if not path_rows:
+        return {}
+
+    conn = sqlite3.connect(index_path)
+    try:
+        columns = [c[1] for c in conn.execute('PRAGMA table_info(products)')]
+        if 'min_lat' not in columns:
+            raise ValueError('catalogue index {0} has no footprints; run '
+                             'level2_order_download.py to rebuild it'.format(index_path))
+        rows = conn.execute('SELECT path_row, MIN(min_lon), MIN(min_lat), '
+                            'MAX(max_lon), MAX(max_lat) FROM products '
+                            'WHERE path_row IN ({0}) AND min_lat IS NOT NULL '
+                            'GROUP BY path_row'.format(', '.join('?' * len(path_rows))),
+                            tuple(path_rows)).fetchall()
+    finally:
+        conn.close()
+    return dict((row[0], row[1:]) for row in rows)
+
+
+def index_tile(product, tile, sensors, time, output_dir, indices=('ndvi',),
+               percentiles=()):
+    """
+    Compute the per-pixel statistics of band ratio indices over one tile and
+    write a float32 GeoTIFF per index, with the bands count, min, max, mean
+    and the percentiles.
+
+    :param product: the product grid, as returned by
+                    :func:`geomedian.read_product`
+    :param tile: the (i, j) tile index
+    :param sensors: the sensors, e.g. ['ls8', 'ls7']
+    :param time: the (start, end) dates, as 'YYYY-MM-DD' strings
+    :param output_dir: the folder of the output GeoTIFFs
+    :param indices: the names of the indices
+    :param percentiles: the percentiles wanted of each index
+
+    :returns: the GeoTIFFs written, or None if the tile has no data
+
+    """
+
+    if Datacube is None:
+        raise ImportError('datacube is required to compute tiles')
+
+    dc = Datacube(app='tile_scheduler')
+    query = tile_query(product, tile, time)
+    measurements = sorted(set(band for index in indices for band in INDICES[index]))
+    reducers = index_statistics(indices, percentiles)
+    streams = [load_sensor(dc, sensor, measurements, query) for sensor in sensors]
+    for acquired, sensor, bands in merge_sensors(streams):
+        for reducer in reducers.values():
+            reducer.update(acquired, bands)
+
+    names = ['count', 'min', 'max', 'mean'] + ['p{0:g}'.format(q) for q in percentiles]
+    written = []
+    for index in indices:
+        result = reducers[index].result()
+        if result is None:
+            continue
+        filename = os.path.join(output_dir, '{0}_{1}_{2}_{3}.tif'.format(
+            index, tile[0], tile[1], time[0][:4]))
+        data = np.stack([result[name] for name in names]).astype(np.float32)
+        written.append(write_tile(product, tile, data, filename, names, np.nan))
+    return written or None
+
+
+def run_job(spec):
+    """
+    Run one tile job.
+
+    :param spec: the job, as queued by :func:`plan`
+
+    :returns: the files written, or None if the tile has no data
+    :raises ValueError: for an unknown statistic
+
+    """
+
+    product = read_product(spec['product'])
+    # jobs queued before the crs was recorded use that of the product
+    product['crs'] = spec.get('crs', product['crs'])
+    tile = tuple(spec['tile'])
+    time = tuple(spec['time'])
+    if not os.path.isdir(spec['output_dir']):
+        try:
+            os.makedirs(spec['output_dir'])
+        except OSError:
+            pass  # made by another worker
+    if spec['statistic'] == 'geomedian':
+        return compute_tile(product, tile, spec['sensors'], time, spec['output_dir'])
+    if spec['statistic'] == 'index':
+        return index_tile(product, tile, spec['sensors'], time, spec['output_dir'],
+                          spec['indices'], spec['percentiles'])
+    raise ValueError('unknown statistic {0}'.format(spec['statistic']))
+
+
+def plan(queue_dir, statistic, year, sensors, output_dir, config_path=CONFIG,
+         product_yaml=PRODUCT_YAML, indices=('ndvi',), percentiles=(), crs=None):
+    """
+    Queue a job for every tile of the product grid over the path/rows of the
+    configuration file. Tiles already queued, in any state, are not queued
+    again, so planning can be repeated as path/rows are added.
+
+    :param queue_dir: the queue folder
+    :param statistic: 'geomedian' or 'index'
+    :param year: the year to summarise
+    :param sensors: the sensors, e.g. ['ls8', 'ls7']
+    :param output_dir: the folder of the output GeoTIFFs
+    :param config_path: the download configuration file, giving the path/rows
+                        and the catalogue
+    :param product_yaml: the product definition giving the tile grid
+    :param indices: the indices of the 'index' statistic
+    :param percentiles: the percentiles of the 'index' statistic
+    :param crs: the crs of the output grid, None for that of the product
+                definition
+
+    :returns: the number of jobs queued
+    :raises ValueError: if the crs does not suit the path/rows, see
+                        :func:`geomedian.check_crs`
+
+    """
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    path_rows = config.get('Process', 'path_row_list').split()
+    product_id_path = os.path.join(config.get('Process', 'root_folder'),
+                                   config.get('Process', 'product_id_filename'))
+
+    bounds = path_row_bounds(product_id_path, path_rows)
+    for path_row in path_rows:
+        if path_row not in bounds:
+            print('no footprint of path/row {0} in the catalogue; '
+                  'rebuild it with incremental_catalogue = False'.format(path_row))
+
+    product = read_product(product_yaml)
+    if crs:
+        product['crs'] = crs
+    tiles = set()
+    for min_lon, min_lat, max_lon, max_lat in bounds.values():
+        tiles.update(product_tiles(product, (min_lon, max_lon), (min_lat, max_lat)))
+
+    queue = TileQueue(queue_dir)
+    count = 0
+    for i, j in sorted(tiles):
+        spec = {'statistic': statistic, 'tile': [i, j],
+                'time': ['{0}-01-01'.format(year), '{0}-12-31'.format(year)],
+                'sensors': list(sensors), 'output_dir': os.path.abspath(output_dir),
+                'product': os.path.abspath(product_yaml), 'crs': product['crs'],
+                'indices': list(indices), 'percentiles': list(percentiles)}
+        if queue.add('{0}_{1}_{2}_{3}.json'.format(statistic, i, j, year), spec):
+            count += 1
+    print('{0} tile(s) over {1} path/row(s), {2} job(s) queued'.format(
+        len(tiles), len(bounds), count))
+    return count
+
+
+def work(queue_dir):
+    """
+    Run queued jobs until none is left waiting.
+
+    :param queue_dir: the queue folder
+
+    :returns: the number of jobs done and failed
+
+    """
+
+    queue = TileQueue(queue_dir)
+    done = failed = 0
+    while True:
+        job = queue.claim()
+        if job is None:
+            return done, failed
+        name, spec = job
+        try:
+            run_job(spec)
+        except Exception:
+            error = '{0}: {1}'.format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+            print("Oops!", error, "occured.")
+            print('failed: ' + name)
+            if not queue.fail(name, error):
+                print('{0} was queued again while running'.format(name))
+            failed += 1
+        else:
+            if queue.complete(name):
+                print('done: ' + name)
+                done += 1
+            else:
+                print('{0} was queued again while running and claimed by another '
+                      'worker'.format(name))
+
+
+def work_pool(queue_dir, workers=None):
+    """
+    Run queued jobs in a local process pool, each worker claiming jobs until
+    none is left. Start this on every node sharing the queue folder to spread
+    the jobs over them.
+
+    :param queue_dir: the queue folder
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+
+    :returns: the number of jobs done and failed
+
+    """
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(work, [queue_dir] * workers))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def tile_scheduler():
+    parser = argparse.ArgumentParser(
+        description='Compute statistics over every tile of the product grid.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser('plan', help='queue a job per tile')
+    plan_parser.add_argument('queue_dir', help='folder of the work queue')
+    plan_parser.add_argument('output_dir', help='folder of the output GeoTIFFs')
+    plan_parser.add_argument('--statistic', choices=['geomedian', 'index'],
+                             default='geomedian', help='statistic to compute (default: geomedian)')
+    plan_parser.add_argument('--year', type=int, required=True, help='year to summarise')
+    plan_parser.add_argument('--sensors', nargs='+', default=['ls8', 'ls7', 'ls5'],
+                             help='sensors to use (default: ls8 ls7 ls5)')
+    plan_parser.add_argument('--indices', nargs='+', default=['ndvi'],
+                             choices=sorted(INDICES), help='indices of --statistic index')
+    plan_parser.add_argument('--percentiles', type=float, nargs='+', default=[],
+                             help='percentiles of --statistic index')
+    plan_parser.add_argument('--config', default=CONFIG,
+                             help='download configuration giving the path/rows')
+    plan_parser.add_argument('--product', default=PRODUCT_YAML,
+                             help='product definition giving the tile grid')
+    plan_parser.add_argument('--crs', default=None,
+                             help='crs of the tile grid, e.g. EPSG:6372 (default: that of the product)')
+
+    work_parser = subparsers.add_parser('work', help='run queued jobs')
+    work_parser.add_argument('queue_dir', help='folder of the work queue')
+    work_parser.add_argument('--workers', type=int, default=None,
+                             help='number of worker processes (default: number of CPUs)')
+
+    status_parser = subparsers.add_parser('status', help='count the jobs in each state')
+    status_parser.add_argument('queue_dir', help='folder of the work queue')
+
+    retry_parser = subparsers.add_parser('retry', help='queue failed jobs again')
+    retry_parser.add_argument('queue_dir', help='folder of the work queue')
+    retry_parser.add_argument('--stale-after', type=float, default=None,
+                              help='also queue again jobs running longer than this many seconds')
+
+    args = parser.parse_args()
+    if args.command == 'plan':
+        plan(args.queue_dir, args.statistic, args.year, args.sensors, args.output_dir,
+             args.config, args.product, args.indices, args.percentiles, args.crs)
+    elif args.command == 'work':
+        done, failed = work_pool(args.queue_dir, args.workers)
+        print('{0} job(s) done, {1} failed'.format(done, failed))
+    elif args.command == 'status':
+        for state, count in sorted(TileQueue(args.queue_dir).counts().items()):
+            print('{0}: {1}'.format(state, count))
+    else:
+        print('{0} job(s) queued again'.format(
+            TileQueue(args.queue_dir).retry(args.stale_after)))
+
+
+if __name__ == '__main__':
+    tile_scheduler()
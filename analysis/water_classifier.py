@@ -0,0 +1,188 @@
+"""
+:mod:`water_classifier` - Chunked, low-memory evaluation of the WOfS water
+classifier.
+===============================================================================
+
+The regression tree of Mueller et al. (2015), as in ``water_classifier`` of
+``notebooks/water_classifier_and_WOfS.ipynb``, which materialises some thirty
+full size boolean arrays and three float64 ratio arrays for the whole stack.
+Here the tree is written as a single boolean expression per branch and
+evaluated over chunks of pixels, so the temporaries only ever cover one chunk
+and the stack itself can stay int16.
+
+This saves memory, not time. NumPy still evaluates every comparison, and
+both sides of every ``np.where``, for every pixel, so the number of passes
+over the data is about the notebook's and so is the runtime (see
+``benchmark_water_classifier.py``).
+
+The classification is identical to the notebook's: the ratios are computed in
+float64 in the same order, and pixels with nodata in any band (NaN in the
+notebook) fall through the tree the same way, to 0.
+
+"""
+
+import numpy as np
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+NODATA = -9999
+
+# pixels classified per chunk; bounds the temporaries while keeping the
+# per-call overhead of the NumPy operations small
+CHUNK_SIZE = 2 ** 14
+
+
+def _band_ratio(a, b):
+    """
+    Calculates a normalized ratio index
+
+    """
+
+    return (a - b) / (a + b)
+
+
+def _as_float(band, nodata):
+    band = band.astype(np.float64)
+    if nodata is not None:
+        band[band == nodata] = np.nan
+    return band
+
+
+def _classify_chunk(band1, band2, band3, band4, band5, band7):
+    # zero sums give inf or NaN ratios, classified as in the notebook
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndi_52 = _band_ratio(band5, band2)
+        ndi_43 = _band_ratio(band4, band3)
+        ndi_72 = _band_ratio(band7, band2)
+
+    # left branch, nodes 3 to 20
+    left = (ndi_52 <= -0.01) & (band1 <= 2083.5) & np.where(
+        band7 <= 323.5,
+        ndi_43 <= 0.61,
+        np.where(band1 <= 1400.5,
+                 np.where(ndi_72 <= -0.23,
+                          (ndi_43 <= 0.22) | (band1 <= 473),
+                          band1 <= 379),
+                 ndi_43 <= -0.01))
+
+    # right branch, nodes 23 to 45; comparisons with NaN are False, so
+    # nodata pixels end up here, at node 36
+    right = ~(ndi_52 <= -0.01) & np.where(
+        ndi_52 <= 0.23,
+        (band1 <= 334.5) & (ndi_43 <= 0.54) &
+        ((ndi_52 <= 0.12) | np.where(band3 <= 364.5,
+                                     band1 <= 129.5,
+                                     band1 <= 300.5)),
+        (ndi_52 <= 0.34) & (band1 <= 249.5) & (ndi_43 <= 0.45) &
+        (band3 <= 364.5) & (band1 <= 129.5))
+
+    return left | right
+
+
+def classify(blue, green, red, nir, swir1, swir2, nodata=NODATA,
+             chunk_size=CHUNK_SIZE):
+    """
+    Classify water with the WOfS regression tree, chunk by chunk.
+
+    :param blue: the blue band, any shape, int16 or float
+    :param green: the green band
+    :param red: the red band
+    :param nir: the near infrared band
+    :param swir1: the first shortwave infrared band
+    :param swir2: the second shortwave infrared band
+    :param nodata: the nodata value of the bands, treated like NaN; None if
+                   there is none
+    :param chunk_size: the number of pixels classified at a time
+
+    :returns: a uint8 array the shape of the bands, 1 for water, 0 otherwise
+
+    """
+
+    bands = [np.asarray(band).reshape(-1)
+             for band in (blue, green, red, nir, swir1, swir2)]
+    classified = np.empty(bands[0].shape, dtype=np.uint8)
+
+    for start in range(0, len(classified), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        classified[chunk] = _classify_chunk(*[_as_float(band[chunk], nodata)
+                                              for band in bands])
+    return classified.reshape(np.shape(blue))
+
+
+def water_classifier(dataset_in, nodata=NODATA, chunk_size=CHUNK_SIZE):
+    """
+    Classify water in a dataset, a drop-in for the notebook function.
+
+    :param dataset_in: an ``xarray.Dataset`` with blue, green, red, nir, swir1
+                       and swir2 variables on (time, y, x)
+    :param nodata: the nodata value of the bands, treated like NaN
+    :param chunk_size: the number of pixels classified at a time
+
+    :returns: an ``xarray.Dataset`` with the float64 ``wofs`` classification,
+              as in the notebook
+
+    """
+
+    if xr is None:
+        raise ImportError('xarray is required for water_classifier, use classify')
+
+    classified = classify(dataset_in.blue.values, dataset_in.green.values,
+                          dataset_in.red.values, dataset_in.nir.values,
+                          dataset_in.swir1.values, dataset_in.swir2.values,
+                          nodata, chunk_size)
+
+    coords = [dataset_in.time, dataset_in.y, dataset_in.x]
+    data_array = xr.DataArray(classified.astype('float64'), coords=coords,
+                              dims=['time', 'y', 'x'])
+    return xr.Dataset({'wofs': data_array},
+                      coords={'time': dataset_in.time, 'y': dataset_in.y,
+                              'x': dataset_in.x})
+
+
+class WaterSummary(object):
+    """
+    Reducer of :mod:`tile_loader` building the WOfS summary of the notebook,
+    the percentage of clear observations of each pixel classified as water,
+    one time slice at a time.
+
+    :param nodata: the nodata value of the bands
+
+    """
+
+    def __init__(self, nodata=NODATA):
+        self.nodata = nodata
+        self.wet = None
+        self.clear = None
+
+    def update(self, time, bands):
+        """
+        Add one time slice.
+
+        :param time: the time of the slice
+        :param bands: the cloud masked bands of the slice, (y, x) arrays
+                      keyed by name
+
+        """
+
+        if self.wet is None:
+            self.wet = np.zeros(bands['blue'].shape, dtype=np.uint32)
+            self.clear = np.zeros(bands['blue'].shape, dtype=np.uint32)
+        self.wet += classify(bands['blue'], bands['green'], bands['red'],
+                             bands['nir'], bands['swir1'], bands['swir2'],
+                             self.nodata)
+        self.clear += bands['blue'] != self.nodata
+
+    def result(self):
+        """
+        :returns: the water percentage of every pixel, NaN where no clear
+                  observation was seen; None if no time slice was seen
+
+        """
+
+        if self.wet is None:
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.wet * 100. / self.clear
@@ -0,0 +1,160 @@
+"""
+:mod:`bulk_metadata` - Parse the USGS Landsat bulk metadata files.
+===============================================================================
+
+Columns are located by name from each file's header rather than by position,
+so a change to the USGS column order cannot silently select the wrong field.
+
+"""
+
+import csv
+import gzip
+
+# accepted header names of the columns used from the bulk metadata files
+BULK_METADATA_COLUMNS = {
+    'product_id': ['LANDSAT_PRODUCT_ID'],
+    'path': ['path', 'WRS_PATH'],
+    'row': ['row', 'WRS_ROW'],
+    'acquired': ['acquisitionDate', 'DATE_ACQUIRED'],
+    'cloud_cover': ['cloudCover', 'CLOUD_COVER'],
+}
+
+# columns written when present, left blank otherwise
+OPTIONAL_BULK_METADATA_COLUMNS = {
+    'cloud_cover_land': ['CLOUD_COVER_LAND', 'cloudCoverLand'],
+    'ul_lat': ['upperLeftCornerLatitude', 'CORNER_UL_LAT_PRODUCT'],
+    'ul_lon': ['upperLeftCornerLongitude', 'CORNER_UL_LON_PRODUCT'],
+    'ur_lat': ['upperRightCornerLatitude', 'CORNER_UR_LAT_PRODUCT'],
+    'ur_lon': ['upperRightCornerLongitude', 'CORNER_UR_LON_PRODUCT'],
+    'll_lat': ['lowerLeftCornerLatitude', 'CORNER_LL_LAT_PRODUCT'],
+    'll_lon': ['lowerLeftCornerLongitude', 'CORNER_LL_LON_PRODUCT'],
+    'lr_lat': ['lowerRightCornerLatitude', 'CORNER_LR_LAT_PRODUCT'],
+    'lr_lon': ['lowerRightCornerLongitude', 'CORNER_LR_LON_PRODUCT'],
+}
+
+CORNERS = ('ul', 'ur', 'll', 'lr')
+
+# malformed records reported one by one before only being counted
+MAX_REPORTED_ROWS = 10
+
+
+def open_bulk_metadata(csv_gz):
+    """
+    Open a gzipped bulk metadata file for streaming, decompressing it chunk by
+    chunk as it is read so memory use is bounded whatever the file size.
+
+    :param csv_gz: the gzipped text file
+
+    :returns: a text file object
+
+    """
+
+    return gzip.open(csv_gz, 'rt', newline='')
+
+
+def resolve_columns(header, columns=BULK_METADATA_COLUMNS, required=True):
+    """
+    Find the position of each wanted column in a bulk metadata header.
+
+    :param header: the header row
+    :param columns: accepted header names keyed by field
+    :param required: raise if a column is missing, otherwise leave it out
+
+    :returns: column positions keyed by field
+    :raises ValueError: if a required column is not in the header
+
+    """
+
+    positions = {}
+    for field, names in columns.items():
+        for name in names:
+            if name in header:
+                positions[field] = header.index(name)
+                break
+        else:
+            if not required:
+                continue
+            raise ValueError('Column {0} not found in bulk metadata '
+                             'header'.format(' / '.join(names)))
+    return positions
+
+
+def footprint_bounds(row, col):
+    """
+    Get the latitude/longitude bounding box of a scene from its corners.
+
+    :param row: a bulk metadata record
+    :param col: column positions keyed by field
+
+    :returns: min lat, max lat, min lon and max lon, all blank if a corner is
+              missing
+
+    """
+
+    try:
+        lats = [float(row[col[corner + '_lat']]) for corner in CORNERS]
+        lons = [float(row[col[corner + '_lon']]) for corner in CORNERS]
+    except (KeyError, IndexError, ValueError):
+        return ['', '', '', '']
+    return [min(lats), max(lats), min(lons), max(lons)]
+
+
+def extract_product_ids(csv_gz, output_csv):
+    """
+    Stream a gzipped bulk metadata file and write the product ids of its
+    collection scenes (real-time scenes excluded), with their scene and land
+    cloud cover and the bounding box of their footprint, to a csv file
+    without header. Each product id is checked against the path, row and
+    acquisition date columns; records that are short or do not match are
+    reported and skipped rather than aborting the refresh.
+
+    :param csv_gz: the gzipped bulk metadata file
+    :param output_csv: the csv file to write
+
+    :returns: the csv file and the number of product ids written
+    :raises ValueError: if the header lacks a column
+
+    """
+
+    count = 0
+    skipped = 0
+    with open_bulk_metadata(csv_gz) as f, open(output_csv, 'w') as h:
+        reader = csv.reader(f, delimiter=',')
+        writer = csv.writer(h, delimiter=',', lineterminator='\n')
+        header = next(reader)
+        col = resolve_columns(header)
+        col.update(resolve_columns(header, OPTIONAL_BULK_METADATA_COLUMNS,
+                                   required=False))
+
+        for row in reader:
+            try:
+                product_id = row[col['product_id']]
+                if not product_id or product_id[-2:] == 'RT':
+                    continue
+
+                fields = product_id.split('_')
+                path_row = row[col['path']].zfill(3) + row[col['row']].zfill(3)
+                acquired = row[col['acquired']].replace('-', '').replace('/', '')
+                if len(fields) != 7 or fields[2] != path_row or fields[3] != acquired:
+                    raise ValueError('product id {0} does not match path/row {1} '
+                                     'and date {2}'.format(product_id, path_row,
+                                                           acquired))
+
+                cloud_cover_land = row[col['cloud_cover_land']] \
+                    if 'cloud_cover_land' in col else ''
+                record = [product_id, row[col['cloud_cover']],
+                          cloud_cover_land] + footprint_bounds(row, col)
+            except (IndexError, ValueError) as e:
+                skipped += 1
+                if skipped <= MAX_REPORTED_ROWS:
+                    print('skipping record {0} of {1}: {2}'.format(
+                        reader.line_num, csv_gz, e if isinstance(e, ValueError)
+                        else 'too few columns'))
+                continue
+
+            writer.writerow(record)
+            count += 1
+
+    if skipped:
+        print('skipped {0} malformed record(s) of {1}'.format(skipped, csv_gz))
+    return output_csv, count
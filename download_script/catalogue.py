@@ -0,0 +1,264 @@
+"""
+:mod:`catalogue` - Indexed catalogue of Landsat product IDs, queried by
+path/row and acquisition date.
+===============================================================================
+
+The product id file produced by :func:`level2_order_download.produce_id_file`
+is loaded once into a SQLite database keyed by sensor, path/row and
+acquisition date, so selecting the scenes of a path/row and date range is an
+index lookup rather than a scan of the whole file. The scene and land cloud
+cover of each product are kept so cloudy scenes can be left out of orders,
+and the bounding box of its footprint so the area of a path/row is known
+before any of it is downloaded.
+
+"""
+
+import csv
+import json
+import os
+import sqlite3
+
+
+def catalogue_index_path(product_id_path):
+    """
+    Get the name of the index belonging to a product id file.
+
+    :param product_id_path: the product id file
+
+    :returns: the index file name
+
+    """
+
+    return os.path.splitext(product_id_path)[0] + '.db'
+
+
+def parse_product_id(product_id):
+    """
+    Split a Landsat collection product id into its indexed fields.
+
+    :param product_id: e.g. LE07_L1TP_018045_20110102_20161210_01_T1
+
+    :returns: sensor, path/row and acquisition date
+
+    """
+
+    fields = product_id.split('_')
+    return fields[0], fields[2], fields[3]
+
+
+def _coordinate(value):
+    """
+    Convert a coordinate field, blank when unknown, to a number.
+
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cloud_cover(value):
+    """
+    Convert a cloud cover field, blank or negative when unknown, to a number.
+
+    """
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def _index_rows(rows):
+    """
+    Turn product id file rows into index rows. Product id files written before
+    cloud cover or footprints were recorded have the product id only, or no
+    footprint.
+
+    """
+
+    for row in rows:
+        if row:
+            row = row + [None] * (7 - len(row))
+            yield ((row[0],) + parse_product_id(row[0]) +
+                   (_cloud_cover(row[1]), _cloud_cover(row[2])) +
+                   tuple(_coordinate(value) for value in row[3:7]))
+
+
+def build_catalogue_index(product_id_path, index_path=None):
+    """
+    Load a product id file into a SQLite index, replacing any existing index.
+
+    :param product_id_path: the product id file
+    :param index_path: the index file, defaults to the product id file name
+                       with a ``.db`` extension
+
+    :returns: the index file
+
+    """
+
+    if index_path is None:
+        index_path = catalogue_index_path(product_id_path)
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE products (product_id TEXT PRIMARY KEY, '
+                 'sensor TEXT, path_row TEXT, acquired TEXT, '
+                 'cloud_cover REAL, cloud_cover_land REAL, '
+                 'min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL)')
+    with open(product_id_path, 'r') as f:
+        reader = csv.reader(f, delimiter=',')
+        next(reader)  # header
+        conn.executemany('INSERT OR IGNORE INTO products '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', _index_rows(reader))
+    conn.execute('CREATE INDEX products_path_row_acquired '
+                 'ON products (path_row, acquired, sensor)')
+    conn.commit()
+    conn.close()
+
+    os.replace(tmp_path, index_path)
+    print('Indexed LANDSAT product ids in: ' + index_path)
+    return index_path
+
+
+def open_catalogue_index(product_id_path):
+    """
+    Open the index of a product id file, (re)building it if it is missing,
+    older than the product id file or lacking the cloud cover or footprint
+    columns.
+
+    :param product_id_path: the product id file
+
+    :returns: a :class:`sqlite3.Connection`
+
+    """
+
+    index_path = catalogue_index_path(product_id_path)
+    if not os.path.exists(index_path) or \
+            os.path.getmtime(index_path) < os.path.getmtime(product_id_path):
+        build_catalogue_index(product_id_path, index_path)
+
+    conn = sqlite3.connect(index_path)
+    columns = [c[1] for c in conn.execute('PRAGMA table_info(products)')]
+    if 'cloud_cover_land' not in columns or 'min_lat' not in columns:
+        conn.close()
+        build_catalogue_index(product_id_path, index_path)
+        conn = sqlite3.connect(index_path)
+    return conn
+
+
+def query_products(product_id_path, path_rows, date_ranges,
+                   max_cloud_cover=None):
+    """
+    Select the product ids of many path/rows and date ranges in one pass over
+    the index.
+
+    The cloud cover limit applies to the land cloud cover, or to the scene
+    cloud cover where the land value is unknown. Scenes with neither value
+    are kept.
+
+    :param product_id_path: the product id file
+    :param path_rows: a list of path/rows, e.g. ['018045', '018046']
+    :param date_ranges: a list of date ranges, e.g. ['20110101_20121231']
+    :param max_cloud_cover: the highest cloud cover percentage accepted, None
+                            for no limit
+
+    :returns: a dictionary of product id lists keyed by (path/row, date range)
+
+    """
+
+    result = dict(((path_row, date_range), [])
+                  for path_row in path_rows for date_range in date_ranges)
+
+    conn = open_catalogue_index(product_id_path)
+    conn.execute('CREATE TEMP TABLE wanted (path_row TEXT, date_range TEXT, '
+                 'ymd1 TEXT, ymd2 TEXT)')
+    conn.executemany('INSERT INTO wanted VALUES (?, ?, ?, ?)',
+                     ((path_row, date_range) + tuple(date_range.split('_'))
+                      for path_row, date_range in result))
+    sql = ('SELECT w.path_row, w.date_range, p.product_id '
+           'FROM wanted w JOIN products p '
+           'ON p.path_row = w.path_row '
+           'AND p.acquired BETWEEN w.ymd1 AND w.ymd2 ')
+    params = ()
+    if max_cloud_cover is not None:
+        sql += ('WHERE COALESCE(p.cloud_cover_land, p.cloud_cover) IS NULL '
+                'OR COALESCE(p.cloud_cover_land, p.cloud_cover) <= ? ')
+        params = (max_cloud_cover,)
+    rows = conn.execute(sql + 'ORDER BY p.acquired, p.product_id', params)
+    for path_row, date_range, product_id in rows:
+        result[(path_row, date_range)].append(product_id)
+    conn.close()
+
+    return result
+
+
+def merge_product_ids(product_id_path, ids_path):
+    """
+    Merge product ids into an existing product id file and its index,
+    appending only the ids not catalogued yet.
+
+    :param product_id_path: the product id file
+    :param ids_path: a csv file of product ids, cloud cover and footprints
+                     without header
+
+    :returns: the number of new product ids
+
+    """
+
+    conn = open_catalogue_index(product_id_path)
+    new_rows = []
+    seen = set()
+    with open(ids_path, 'r') as f:
+        for row in csv.reader(f, delimiter=','):
+            if row and row[0] not in seen and conn.execute(
+                    'SELECT 1 FROM products WHERE product_id = ?',
+                    (row[0],)).fetchone() is None:
+                new_rows.append(row)
+                seen.add(row[0])
+
+    # the product id file is written before the index so the index stays the
+    # newer of the two and is not rebuilt on the next open
+    with open(product_id_path, 'a') as h:
+        writer = csv.writer(h, delimiter=',', lineterminator='\n')
+        writer.writerows(new_rows)
+    conn.executemany('INSERT OR IGNORE INTO products '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', _index_rows(new_rows))
+    conn.commit()
+    conn.close()
+
+    return len(new_rows)
+
+
+def load_refresh_state(state_path):
+    """
+    Load the HTTP validators recorded at the last catalogue refresh.
+
+    :param state_path: the refresh state file
+
+    :returns: a dictionary of ETag/Last-Modified values keyed by url
+
+    """
+
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def save_refresh_state(state_path, state):
+    """
+    Record the HTTP validators of the refreshed catalogues.
+
+    :param state_path: the refresh state file
+    :param state: a dictionary of ETag/Last-Modified values keyed by url
+
+    """
+
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(state_path + '.tmp', state_path)
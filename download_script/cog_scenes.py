@@ -0,0 +1,164 @@
+#!/bin/env python
+"""
+:mod:`cog_scenes` - Rewrite unpacked scene bands as Cloud-Optimized GeoTIFFs.
+===============================================================================
+
+ESPA delivers striped, uncompressed GeoTIFFs, so reading a small area means
+reading whole strips across the scene. Each band is rewritten as an
+internally tiled, compressed GeoTIFF with overviews (GDAL's COG driver,
+GDAL >= 3.1), so windowed reads only touch the tiles they need.
+
+"""
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import rasterio
+    import rasterio.shutil
+except ImportError:
+    rasterio = None
+
+# bit flag bands, whose overviews must pick values rather than average them
+FLAG_BANDS = ('pixel_qa', 'radsat_qa', 'sr_aerosol', 'sr_cloud_qa', 'bqa')
+
+
+def require_cog():
+    """
+    Check that Cloud-Optimized GeoTIFFs can be written, before any scene is
+    unpacked or converted.
+
+    :raises ImportError: if rasterio is not installed
+
+    """
+
+    if rasterio is None:
+        raise ImportError('rasterio is required to write Cloud-Optimized GeoTIFFs')
+
+
+def is_flag_band(tif_path):
+    """
+    Decide whether a band holds bit flags, from the ESPA band name its file
+    name ends with, e.g. LC08_L1TP_018045_20200101_20200110_01_T1_sr_aerosol.tif
+
+    :param tif_path: the GeoTIFF
+
+    :returns: True for a band in :data:`FLAG_BANDS`
+
+    """
+
+    base = os.path.splitext(os.path.basename(tif_path))[0].lower()
+    return any(base == band or base.endswith('_' + band) for band in FLAG_BANDS)
+
+
+def band_to_cog(tif_path, compress='DEFLATE', blocksize=512):
+    """
+    Rewrite one GeoTIFF band in place as a Cloud-Optimized GeoTIFF. Bit flag
+    bands (:data:`FLAG_BANDS`) get nearest neighbour overviews so their flags
+    stay valid.
+
+    :param tif_path: the GeoTIFF to rewrite
+    :param compress: the compression method
+    :param blocksize: the tile size in pixels
+
+    :returns: the GeoTIFF
+    :raises ImportError: if rasterio is not installed
+
+    """
+
+    require_cog()
+    resampling = 'NEAREST' if is_flag_band(tif_path) else 'AVERAGE'
+    tmp_path = tif_path + '.cog.tmp'
+    rasterio.shutil.copy(tif_path, tmp_path, driver='COG', COMPRESS=compress,
+                         PREDICTOR='YES', BLOCKSIZE=blocksize,
+                         OVERVIEW_RESAMPLING=resampling, BIGTIFF='IF_SAFER')
+    os.replace(tmp_path, tif_path)
+    return tif_path
+
+
+def scene_to_cog(scene_folder, compress='DEFLATE', blocksize=512):
+    """
+    Rewrite every GeoTIFF band of a scene folder as a Cloud-Optimized GeoTIFF.
+
+    :param scene_folder: the unpacked scene
+    :param compress: the compression method
+    :param blocksize: the tile size in pixels
+
+    :returns: the scene folder
+
+    """
+
+    for tif_path in sorted(glob.glob(os.path.join(scene_folder, '*.tif'))):
+        band_to_cog(tif_path, compress, blocksize)
+    return scene_folder
+
+
+def _scene_to_cog(scene_folder, compress, blocksize):
+    """
+    Convert one scene in a worker process, reporting rather than raising
+    errors so one bad scene does not stop the others.
+
+    """
+
+    try:
+        return scene_to_cog(scene_folder, compress, blocksize), None
+    except Exception:
+        return None, '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                       sys.exc_info()[1])
+
+
+def cog_all(scene_folders, workers=None, compress='DEFLATE', blocksize=512):
+    """
+    Convert many scenes concurrently.
+
+    :param scene_folders: a list of unpacked scene folders
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+    :param compress: the compression method
+    :param blocksize: the tile size in pixels
+
+    :returns: a list of the scene folders that could not be converted
+    :raises ImportError: if rasterio is not installed
+
+    """
+
+    require_cog()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_scene_to_cog, scene_folder, compress,
+                                        blocksize), scene_folder)
+                       for scene_folder in scene_folders)
+        for future in as_completed(futures):
+            scene_folder = futures[future]
+            done, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping: ' + scene_folder)
+                failed.append(scene_folder)
+            else:
+                print('scene {0} converted'.format(done))
+    return failed
+
+
+def cog_scenes():
+    parser = argparse.ArgumentParser(
+        description='Rewrite unpacked USGS Landsat scenes as Cloud-Optimized GeoTIFFs.')
+    parser.add_argument('target_folder', help='path to your ungzipped/untarred USGS Landsat scenes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of scenes converted in parallel (default: number of CPUs)')
+    parser.add_argument('--compress', default='DEFLATE',
+                        help='compression method, e.g. DEFLATE, LZW, ZSTD (default: DEFLATE)')
+    parser.add_argument('--blocksize', type=int, default=512,
+                        help='tile size in pixels (default: 512)')
+    args = parser.parse_args()
+    # path/row/scene folders, leaving out scenes still being unpacked
+    scene_folders = [folder for folder in glob.glob(args.target_folder + '/*/*/')
+                     if not folder.rstrip('/').endswith('.tmp')]
+    cog_all(scene_folders, args.workers, args.compress, args.blocksize)
+
+
+if __name__ == '__main__':
+    cog_scenes()
@@ -0,0 +1,206 @@
+"""
+:mod:`dataset_docs` - Datacube dataset documents for unpacked ESPA scenes.
+===============================================================================
+
+The dataset document of a scene is built from the ESPA XML metadata while the
+scene is unpacked, and written next to its bands. The documents of many scenes
+are also appended to one multi-document manifest, so a whole run can be
+indexed with a single ``datacube dataset add`` without crawling the scene
+folders again.
+
+"""
+
+import os
+import threading
+import uuid
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+ESPA_NS = '{http://espa.cr.usgs.gov/v2}'
+
+# measurement names of the ls*_usgs_sr_scene products, by sensor; bands not
+# listed keep their ESPA name, e.g. pixel_qa
+OLI_BANDS = {'sr_band1': 'coastal_aerosol', 'sr_band2': 'blue',
+             'sr_band3': 'green', 'sr_band4': 'red', 'sr_band5': 'nir',
+             'sr_band6': 'swir1', 'sr_band7': 'swir2'}
+TM_BANDS = {'sr_band1': 'blue', 'sr_band2': 'green', 'sr_band3': 'red',
+            'sr_band4': 'nir', 'sr_band5': 'swir1', 'sr_band7': 'swir2'}
+BAND_NAMES = {'LC08': OLI_BANDS, 'LE07': TM_BANDS, 'LT05': TM_BANDS,
+              'LT04': TM_BANDS}
+
+INSTRUMENTS = {'OLI/TIRS_Combined': 'OLI_TIRS', 'OLI/TIRS': 'OLI_TIRS'}
+
+
+def _corners(element, tag, x, y):
+    return dict((corner.get('location'), (float(corner.get(x)),
+                                          float(corner.get(y))))
+                for corner in element.findall(ESPA_NS + tag))
+
+
+def espa_dataset_doc(xml_root, scene_name, tif_files=None):
+    """
+    Build the datacube dataset document of a scene from its ESPA XML
+    metadata. Band paths are relative to the scene folder.
+
+    :param xml_root: the parsed ESPA XML, an :class:`xml.etree.ElementTree.Element`
+    :param scene_name: the scene name (the product id)
+    :param tif_files: the names of the band files unpacked, None if all bands
+                      were unpacked
+
+    :returns: the dataset document as a dictionary
+    :raises ValueError: if the scene is not in a UTM projection
+
+    """
+
+    global_metadata = xml_root.find(ESPA_NS + 'global_metadata')
+    projection = global_metadata.find(ESPA_NS + 'projection_information')
+    if projection.get('projection') != 'UTM':
+        raise ValueError('unsupported projection {0} of scene {1}'.format(
+            projection.get('projection'), scene_name))
+
+    zone = int(projection.findtext(ESPA_NS + 'utm_proj_params/' + ESPA_NS + 'zone_code'))
+    crs = 'EPSG:{0}'.format(32600 + zone if zone > 0 else 32700 - zone)
+
+    band_names = BAND_NAMES.get(scene_name[:4], {})
+    bands = {}
+    pixel_size = None
+    for band in xml_root.findall(ESPA_NS + 'bands/' + ESPA_NS + 'band'):
+        file_name = band.findtext(ESPA_NS + 'file_name')
+        if tif_files is not None and file_name not in tif_files:
+            continue
+        bands[band_names.get(band.get('name'), band.get('name'))] = {
+            'path': file_name, 'layer': 1}
+        if pixel_size is None:
+            pixel_size = float(band.find(ESPA_NS + 'pixel_size').get('x'))
+
+    # corner points are pixel centres; the extent runs to the pixel edges
+    points = _corners(projection, 'corner_point', 'x', 'y')
+    half = pixel_size / 2 if pixel_size and \
+        projection.findtext(ESPA_NS + 'grid_origin') == 'CENTER' else 0
+    (left, top), (right, bottom) = points['UL'], points['LR']
+    left, top, right, bottom = left - half, top + half, right + half, bottom - half
+
+    lonlat = _corners(global_metadata, 'corner', 'longitude', 'latitude')
+    (west, north), (east, south) = lonlat['UL'], lonlat['LR']
+
+    center_dt = '{0}T{1}'.format(global_metadata.findtext(ESPA_NS + 'acquisition_date'),
+                                 global_metadata.findtext(ESPA_NS + 'scene_center_time').split('.')[0])
+    instrument = global_metadata.findtext(ESPA_NS + 'instrument')
+
+    return {
+        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, 'espa:' + scene_name)),
+        'label': scene_name,
+        'product_type': 'LEVEL2_USGS',
+        'creation_dt': xml_root.findtext('.//' + ESPA_NS + 'production_date'),
+        'platform': {'code': global_metadata.findtext(ESPA_NS + 'satellite')},
+        'instrument': {'name': INSTRUMENTS.get(instrument, instrument)},
+        'format': {'name': 'GeoTiff'},
+        'extent': {
+            'coord': {
+                'ul': {'lat': north, 'lon': west},
+                'ur': {'lat': north, 'lon': east},
+                'll': {'lat': south, 'lon': west},
+                'lr': {'lat': south, 'lon': east},
+            },
+            'from_dt': center_dt,
+            'center_dt': center_dt,
+            'to_dt': center_dt,
+        },
+        'grid_spatial': {
+            'projection': {
+                'geo_ref_points': {
+                    'ul': {'x': left, 'y': top},
+                    'ur': {'x': right, 'y': top},
+                    'll': {'x': left, 'y': bottom},
+                    'lr': {'x': right, 'y': bottom},
+                },
+                'spatial_reference': crs,
+            },
+        },
+        'image': {'bands': bands},
+        'lineage': {'source_datasets': {}},
+    }
+
+
+def dataset_doc_path(scene_folder, scene_name=None):
+    """
+    Get the path of the dataset document of an unpacked scene.
+
+    :param scene_folder: the unpacked scene
+    :param scene_name: the scene name, defaults to the name of the folder
+
+    :returns: the dataset document, <scene folder>/<scene name>.yaml
+
+    """
+
+    scene_folder = scene_folder.rstrip('/')
+    return os.path.join(scene_folder,
+                        (scene_name or os.path.basename(scene_folder)) + '.yaml')
+
+
+def write_dataset_doc(doc, scene_folder):
+    """
+    Write the dataset document of a scene into its folder.
+
+    :param doc: the dataset document
+    :param scene_folder: the scene folder, possibly still under a temporary
+                         name
+
+    :returns: the dataset document file
+    :raises ImportError: if PyYAML is not installed
+
+    """
+
+    if yaml is None:
+        raise ImportError('PyYAML is required to write dataset documents')
+
+    doc_path = dataset_doc_path(scene_folder, doc['label'])
+    with open(doc_path, 'w') as f:
+        yaml.safe_dump(doc, f, default_flow_style=False)
+    return doc_path
+
+
+class DatasetManifest(object):
+    """
+    Multi-document YAML file collecting the dataset documents of many scenes
+    for bulk indexing. Band paths are made absolute, as the manifest does not
+    live in the scene folders. Documents are appended, so the manifest grows
+    across runs; safe to share between threads.
+
+    :param manifest_path: the manifest file, created if missing
+
+    :raises ImportError: if PyYAML is not installed
+
+    """
+
+    def __init__(self, manifest_path):
+        if yaml is None:
+            raise ImportError('PyYAML is required to write a dataset manifest')
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+
+    def add(self, scene_folder):
+        """
+        Append the dataset document of an unpacked scene.
+
+        :param scene_folder: the unpacked scene
+
+        :returns: True if the scene had a dataset document
+
+        """
+
+        doc_path = dataset_doc_path(scene_folder)
+        if not os.path.isfile(doc_path):
+            return False
+        with open(doc_path) as f:
+            doc = yaml.safe_load(f)
+        for band in doc['image']['bands'].values():
+            band['path'] = os.path.abspath(os.path.join(scene_folder, band['path']))
+        with self.lock:
+            with open(self.manifest_path, 'a') as f:
+                yaml.safe_dump(doc, f, default_flow_style=False,
+                               explicit_start=True)
+        return True
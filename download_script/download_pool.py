@@ -0,0 +1,154 @@
+"""
+:mod:`download_pool` - Bounded worker pool for downloading ESPA order items
+concurrently.
+===============================================================================
+
+"""
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by all download workers, capping the aggregate
+    throughput of the pool.
+
+    :param max_bytes_per_sec: the bandwidth ceiling in bytes per second
+
+    """
+
+    def __init__(self, max_bytes_per_sec):
+        self.rate = float(max_bytes_per_sec)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """
+        Block until ``nbytes`` may be written without exceeding the ceiling.
+
+        :param nbytes: the number of bytes just received
+
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadPool(object):
+    """
+    Download completed order items in parallel with a bounded number of
+    workers, a cap on simultaneous connections to one host and an optional
+    aggregate bandwidth ceiling.
+
+    :param download_func: callable ``download_func(url, output_dir,
+                          limiter=None, **kwargs)`` doing the actual transfer
+    :param max_workers: the maximum number of concurrent downloads
+    :param max_per_host: the maximum number of concurrent downloads from a
+                         single host
+    :param max_bandwidth: the aggregate bandwidth ceiling in bytes per
+                          second, ``None`` or 0 for unlimited
+    :param on_complete: an optional callable run by the worker with the
+                        result of every successful download, e.g. to hand it
+                        to the next processing stage
+
+    """
+
+    def __init__(self, download_func, max_workers=4, max_per_host=4,
+                 max_bandwidth=None, on_complete=None):
+        self.download_func = download_func
+        self.on_complete = on_complete
+        self.max_per_host = max_per_host
+        self.limiter = BandwidthLimiter(max_bandwidth) if max_bandwidth else None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.host_slots = {}
+        self.lock = threading.Lock()
+        self.futures = []
+        self.failed = []
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_slots[host]
+
+    def _download(self, url, output_dir, on_done, kwargs):
+        with self._host_slot(url):
+            try:
+                result = self.download_func(url, output_dir,
+                                            limiter=self.limiter, **kwargs)
+                if on_done is not None:
+                    on_done(result)
+                if self.on_complete is not None:
+                    self.on_complete(result)
+            except Exception:
+                print("Oops!", sys.exc_info()[0], "occured.")
+                print('download failed: ' + url)
+                with self.lock:
+                    self.failed.append((url, output_dir))
+                raise
+        print('downloaded: ' + url)
+        return result
+
+    def submit(self, url, output_dir, on_done=None, **kwargs):
+        """
+        Queue an item for download.
+
+        :param url: the download url of the item
+        :param output_dir: the folder to store the downloaded item
+        :param on_done: an optional callable run by the worker with the
+                        result of a successful download, before :meth:`wait`
+                        can return
+        :param kwargs: further keyword arguments of the download function
+
+        :returns: a :class:`concurrent.futures.Future` for the result of the
+                  download function
+
+        """
+
+        future = self.executor.submit(self._download, url, output_dir, on_done,
+                                      kwargs)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Block until every queued download has finished.
+
+        :returns: a list of (url, output_dir) tuples that failed to download
+
+        """
+
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        return list(self.failed)
+
+    def shutdown(self):
+        """
+        Wait for outstanding downloads and release the worker threads.
+
+        """
+
+        self.executor.shutdown(wait=True)
@@ -169,19 +169,34 @@ def fl_get_stat(filename, chunk_whole=2 ** 16):
         raise IOError('Input file is not a valid file: %s' % (filename))
 
     moddate = ctime(si.st_mtime)
-    m = md5_constructor()
-    f = open(filename, 'rb')
-
-    while True:
-        chunk = f.read(chunk_whole)
-        if not chunk:
-            break
-        m.update(chunk)
-    md5sum = m.hexdigest()
+    md5sum = fl_md5(filename, chunk_whole)
 
     return directory, fname, md5sum, moddate
 
 
+def fl_md5(filename, chunk_whole=2 ** 16):
+    """
+    Calculate the md5sum of a file, reading it in chunks.
+
+    :param str filename: Filename to check.
+    :param int chunk_whole: (optional) chunk size (for md5sum calculation).
+
+    :returns: md5sum of the file as a hexadecimal string.
+
+    :Example: md5sum = fl_md5(filename)
+
+    """
+
+    m = md5_constructor()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_whole)
+            if not chunk:
+                break
+            m.update(chunk)
+    return m.hexdigest()
+
+
 def fl_config_file(extension='.ini', prefix='', level=None):
     """
     Build a configuration filename (default extension .ini) based on the
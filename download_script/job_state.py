@@ -0,0 +1,225 @@
+"""
+:mod:`job_state` - Persistent record of submitted ESPA orders, their items
+and downloads.
+===============================================================================
+
+Orders are recorded when submitted and items every time their status is
+checked, so an interrupted run can be resumed from the database without the
+order ids being kept by hand, and without polling or downloading again what
+is already on disk.
+
+"""
+
+import sqlite3
+import threading
+import time
+
+# item states from which an item will never become available for download
+UNAVAILABLE_STATUSES = ('unavailable', 'cancelled')
+
+
+class JobStore(object):
+    """
+    SQLite store of orders and items. Safe to share between the poller and
+    the download workers.
+
+    :param db_path: the database file, created if missing
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(
+            'CREATE TABLE IF NOT EXISTS orders ('
+            ' order_id TEXT PRIMARY KEY, path_row TEXT, date_range TEXT,'
+            ' data_dir TEXT, submitted TEXT);'
+            'CREATE TABLE IF NOT EXISTS items ('
+            ' order_id TEXT, name TEXT, status TEXT, download_url TEXT,'
+            ' data_dir TEXT, local_file TEXT, bytes_downloaded INTEGER,'
+            ' checksum TEXT, updated TEXT,'
+            ' PRIMARY KEY (order_id, name));')
+        self.conn.commit()
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+            self.conn.commit()
+        return rows
+
+    def add_order(self, order_id, data_dir, path_row=None, date_range=None):
+        """
+        Record a submitted order.
+
+        :param order_id: the order id
+        :param data_dir: folder to store downloaded data
+        :param path_row: the path/row ordered
+        :param date_range: the date range ordered
+
+        """
+
+        self._execute('INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?, ?)',
+                      (order_id, path_row, date_range, data_dir,
+                       time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def has_order(self, order_id):
+        """
+        Check whether an order is recorded.
+
+        :param order_id: the order id
+
+        :returns: True if the order is in the store
+
+        """
+
+        return bool(self._execute('SELECT 1 FROM orders WHERE order_id = ?',
+                                  (order_id,)))
+
+    def add_items(self, order_id, data_dirs):
+        """
+        Record the items of a submitted order with their download folders,
+        for orders whose scenes go to different folders.
+
+        :param order_id: the order id
+        :param data_dirs: download folders keyed by item name
+
+        """
+
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.executemany('INSERT OR IGNORE INTO items (order_id, name,'
+                                  ' status, data_dir, updated) '
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  ((order_id, name, 'submitted', data_dir, now)
+                                   for name, data_dir in data_dirs.items()))
+            self.conn.commit()
+
+    def item_data_dirs(self, order_id):
+        """
+        Get the download folder of every item of an order.
+
+        :param order_id: the order id
+
+        :returns: download folders keyed by item name
+
+        """
+
+        return dict(self._execute('SELECT name, data_dir FROM items '
+                                  'WHERE order_id = ?', (order_id,)))
+
+    def order_data_dir(self, order_id):
+        """
+        Get the folder an order is downloaded to.
+
+        :param order_id: the order id
+
+        :returns: the data folder, or None for an unknown order
+
+        """
+
+        rows = self._execute('SELECT data_dir FROM orders WHERE order_id = ?',
+                             (order_id,))
+        return rows[0][0] if rows else None
+
+    def update_item(self, order_id, name, status, download_url=None,
+                    data_dir=None):
+        """
+        Record the latest status of an item.
+
+        :param order_id: the order id
+        :param name: the item name
+        :param status: the ESPA item status
+        :param download_url: the download url, once complete
+        :param data_dir: folder to store the downloaded item, used only if
+                         the item has none recorded yet
+
+        """
+
+        self._execute('INSERT INTO items (order_id, name, status, download_url,'
+                      ' data_dir, updated) VALUES (?, ?, ?, ?, ?, ?) '
+                      'ON CONFLICT (order_id, name) DO UPDATE SET'
+                      ' status = excluded.status,'
+                      ' download_url = COALESCE(excluded.download_url,'
+                      '                         download_url),'
+                      ' data_dir = COALESCE(data_dir, excluded.data_dir),'
+                      ' updated = excluded.updated',
+                      (order_id, name, status, download_url, data_dir,
+                       time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def record_download(self, order_id, name, local_file, bytes_downloaded,
+                        checksum=None):
+        """
+        Record a finished download.
+
+        :param order_id: the order id
+        :param name: the item name
+        :param local_file: the downloaded file
+        :param bytes_downloaded: the size of the downloaded file
+        :param checksum: the md5 checksum of the downloaded file
+
+        """
+
+        self._execute('UPDATE items SET local_file = ?, bytes_downloaded = ?,'
+                      ' checksum = ?, updated = ? '
+                      'WHERE order_id = ? AND name = ?',
+                      (local_file, bytes_downloaded, checksum,
+                       time.strftime('%Y-%m-%d %H:%M:%S'), order_id, name))
+
+    def is_downloaded(self, order_id, name):
+        """
+        Check whether an item has been downloaded.
+
+        :param order_id: the order id
+        :param name: the item name
+
+        :returns: True if the download was recorded
+
+        """
+
+        rows = self._execute('SELECT local_file FROM items '
+                             'WHERE order_id = ? AND name = ?',
+                             (order_id, name))
+        return bool(rows) and rows[0][0] is not None
+
+    def pending_items(self, order_id):
+        """
+        Get the items of an order still to be downloaded.
+
+        :param order_id: the order id
+
+        :returns: a list of item names, or None if no item of the order has
+                  been seen yet
+
+        """
+
+        if not self._execute('SELECT 1 FROM items WHERE order_id = ? LIMIT 1',
+                             (order_id,)):
+            return None
+        rows = self._execute('SELECT name FROM items WHERE order_id = ? '
+                             'AND local_file IS NULL AND status NOT IN '
+                             '({0})'.format(', '.join('?' * len(UNAVAILABLE_STATUSES))),
+                             (order_id,) + UNAVAILABLE_STATUSES)
+        return [row[0] for row in rows]
+
+    def outstanding_orders(self):
+        """
+        Get the orders with items still to be downloaded.
+
+        :returns: a list of (order id, data folder) tuples, oldest first
+
+        """
+
+        rows = self._execute('SELECT order_id, data_dir FROM orders '
+                             'ORDER BY submitted, rowid')
+        return [(order_id, data_dir) for order_id, data_dir in rows
+                if self.pending_items(order_id) != []]
+
+    def close(self):
+        """
+        Close the database.
+
+        """
+
+        with self.lock:
+            self.conn.close()
@@ -10,17 +10,31 @@ reflectance, brightness temperature and pixel quality) from USGS.
 # !/bin/env python
 
 import argparse
+import sys
 import time
 
 import logging as log
 import configparser
 from os.path import join as pjoin
 
-from files import fl_start_log
-from functools import wraps, reduce
-import os, json, requests, getpass, gzip
+from files import fl_start_log, fl_md5
+from catalogue import build_catalogue_index, query_products, \
+    merge_product_ids, load_refresh_state, save_refresh_state
+from bulk_metadata import extract_product_ids
+from download_pool import DownloadPool
+from unpack_scenes import UnpackPipeline
+from cog_scenes import require_cog
+from order_poller import OrderPoller
+from job_state import JobStore, UNAVAILABLE_STATUSES
+from order_planner import plan_orders, ordered_scenes
+from functools import wraps, reduce, partial
+from concurrent.futures import ProcessPoolExecutor
+import os, json, requests, getpass
 import shutil
-import csv
+
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from urllib.parse import urlparse, urljoin
@@ -28,27 +42,283 @@ except ImportError:
     from urlparse import urlparse, urljoin
 
 
-def download_file(url, output_dir):
+def _content_total(response):
+    """
+    Get the full size of the remote file from a (partial) response.
+
+    :param response: the response to a GET with or without a Range header
+
+    :returns: the total size in bytes, or None if the server did not say
+
+    """
+
+    content_range = response.headers.get('Content-Range')
+    if content_range:
+        total = content_range.split('/')[-1]
+        return int(total) if total != '*' else None
+    content_length = response.headers.get('Content-Length')
+    return int(content_length) if content_length else None
+
+
+def _validator(response):
+    """
+    Get the validator identifying the version of a file in a response, for
+    an ``If-Range`` header: a strong ETag, else the Last-Modified date.
+
+    :param response: the response to a GET
+
+    :returns: the validator, or None if the server gave neither
+
+    """
+
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _fetch_part(url, part_filename, limiter=None, chunk_size=1024 * 1024,
+                session=None):
+    """
+    Fetch the remainder of a file into its ``.part`` file, continuing from
+    the bytes already on disk with an HTTP Range request.
+
+    The validator of the file (its ETag or Last-Modified date) is kept next
+    to the partial file and sent back with ``If-Range``, so a file changed
+    on the server since the partial download started is fetched again from
+    byte zero rather than appended to the old bytes. A partial file without
+    a validator is discarded.
+
+    :param url: the file url
+    :param part_filename: the partial file to append to
+    :param limiter: an optional :class:`download_pool.BandwidthLimiter`
+    :param chunk_size: the number of bytes read per chunk
+    :param session: an optional shared :class:`requests.Session`
+
+    :raises IOError: if the transfer ends short of the advertised size
+
+    """
+
+    validator_filename = part_filename + '.validator'
+    validator = None
+    if os.path.exists(validator_filename):
+        with open(validator_filename) as f:
+            validator = f.read().strip() or None
+    offset = os.path.getsize(part_filename) \
+        if validator and os.path.exists(part_filename) else 0
+
+    headers = {}
+    if offset:
+        headers = {'Range': 'bytes={0}-'.format(offset), 'If-Range': validator}
+    http = session if session is not None else requests
+    r = http.get(url, stream=True, headers=headers)
+
+    if r.status_code == 416:
+        # nothing left to fetch, provided the partial file is the whole file
+        total = _content_total(r)
+        r.close()
+        if total is not None and total == offset:
+            return
+        os.remove(part_filename)
+        raise IOError('Stale partial download discarded: ' + part_filename)
+
+    r.raise_for_status()
+    current = _validator(r)
+    if r.status_code == 206 and current == validator:
+        mode = 'ab'
+    else:
+        # the server ignored the Range header or the file changed: start
+        # again from byte zero
+        mode = 'wb'
+        if r.status_code == 206:
+            r.close()
+            os.remove(validator_filename)
+            raise IOError('File changed on the server, restarting: ' + url)
+        if current:
+            with open(validator_filename, 'w') as f:
+                f.write(current)
+        elif os.path.exists(validator_filename):
+            os.remove(validator_filename)
+    total = _content_total(r)
+
+    with open(part_filename, mode) as f:
+        # read the raw stream so sizes match Content-Length and Range offsets
+        for chunk in r.raw.stream(chunk_size, decode_content=False):
+            if chunk:  # filter out keep-alive new chunks
+                f.write(chunk)
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+
+    size = os.path.getsize(part_filename)
+    if total is not None and size != total:
+        raise IOError('Incomplete download of {0}: {1} of {2} bytes'.format(
+            url, size, total))
+
+
+def download_file(url, output_dir, limiter=None, chunk_size=1024 * 1024,
+                  resume=True, max_retries=3, session=None):
     """
     Download the text archive files from USGS website to an output folder.
 
+    In resume mode the data is written to a ``.part`` file which is continued
+    with HTTP Range requests after an interruption, checked against the
+    advertised Content-Length and renamed into place once complete.
+
     :param url: USGS website
     :param output_dir: the output folder
+    :param limiter: an optional :class:`download_pool.BandwidthLimiter`
+                    throttling the transfer
+    :param chunk_size: the number of bytes read per chunk
+    :param resume: resume partial downloads rather than restart them
+    :param max_retries: the number of times an interrupted transfer is resumed
+    :param session: an optional shared :class:`requests.Session`
 
     :returns: the downloaded file
 
     """
 
     local_filename = os.path.join(output_dir, url.split('/')[-1])
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
+
+    if not resume:
+        http = session if session is not None else requests
+        r = http.get(url, stream=True)
+        with open(local_filename, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+                    if limiter is not None:
+                        limiter.consume(len(chunk))
+        return local_filename
+
+    part_filename = local_filename + '.part'
+    for attempt in range(max_retries + 1):
+        try:
+            _fetch_part(url, part_filename, limiter, chunk_size, session)
+            break
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError, IOError) as e:
+            # a connection dropped mid-body surfaces from the raw stream as
+            # urllib3's ProtocolError or ReadTimeoutError
+            if attempt == max_retries:
+                raise
+            print('download interrupted ({0}), resuming: {1}'.format(e, url))
+
+    os.replace(part_filename, local_filename)
+    if os.path.exists(part_filename + '.validator'):
+        os.remove(part_filename + '.validator')
     return local_filename
 
 
-def espa_api(endpoint, verb='get', body=None, uauth=None):
+def fetch_checksum(cksum_url, session=None):
+    """
+    Get the md5 checksum ESPA publishes for an order item.
+
+    :param cksum_url: the url of the item's checksum file
+    :param session: an optional shared :class:`requests.Session`
+
+    :returns: the md5 checksum, or None if it could not be retrieved
+
+    """
+
+    http = session if session is not None else requests
+    try:
+        r = http.get(cksum_url)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print('no checksum for {0}: {1}'.format(cksum_url, e))
+        return None
+    fields = r.text.split()
+    return fields[0].lower() if fields else None
+
+
+def unpacked_scene_folder(unpack_folder, scene_name):
+    """
+    Get the folder ``unpack_scenes.py`` extracts a scene to.
+
+    :param unpack_folder: the target folder of the unpacked scenes
+    :param scene_name: the product id of the scene
+
+    :returns: the scene folder
+
+    """
+
+    return pjoin(unpack_folder, scene_name.split('_')[2], scene_name)
+
+
+def download_item(url, output_dir, limiter=None, session=None,
+                  checksum_url=None, scene_name=None, unpack_folder=None):
+    """
+    Download an order item unless it is already on disk. A scene already
+    unpacked, or an archive matching the ESPA checksum, is kept; an archive
+    failing the checksum is downloaded again.
+
+    :param url: the download url of the item
+    :param output_dir: the folder to store the downloaded item
+    :param limiter: an optional :class:`download_pool.BandwidthLimiter`
+    :param session: an optional shared :class:`requests.Session`
+    :param checksum_url: the url of the item's checksum file
+    :param scene_name: the product id of the item
+    :param unpack_folder: the target folder of the unpacked scenes
+
+    :returns: the local file (or scene folder) and its verified md5 checksum
+    :raises IOError: if the downloaded file does not match the checksum
+
+    """
+
+    if unpack_folder and scene_name:
+        scene_folder = unpacked_scene_folder(unpack_folder, scene_name)
+        if os.path.isdir(scene_folder) and os.listdir(scene_folder):
+            print('already unpacked: ' + scene_folder)
+            return scene_folder, None
+
+    expected = fetch_checksum(checksum_url, session) if checksum_url else None
+    local_filename = os.path.join(output_dir, url.split('/')[-1])
+
+    if os.path.exists(local_filename):
+        md5sum = fl_md5(local_filename)
+        if expected is None or md5sum == expected:
+            print('already downloaded: ' + local_filename)
+            return local_filename, md5sum
+        print('checksum mismatch, downloading again: ' + local_filename)
+        os.remove(local_filename)
+
+    local_filename = download_file(url, output_dir, limiter=limiter,
+                                   session=session)
+    md5sum = fl_md5(local_filename)
+    if expected is not None and md5sum != expected:
+        os.remove(local_filename)
+        raise IOError('Checksum mismatch for {0}: {1} instead of {2}'.format(
+            local_filename, md5sum, expected))
+    return local_filename, md5sum
+
+
+def create_session(pool_size=10, max_retries=5, backoff_factor=2):
+    """
+    Create a HTTP session shared by all ESPA API calls and downloads, keeping
+    connections alive between requests and retrying transient failures.
+
+    :param pool_size: the number of pooled connections kept per host
+    :param max_retries: the number of retries on connection errors and
+                        server errors
+    :param backoff_factor: the exponential backoff factor between retries
+
+    :returns: a :class:`requests.Session`
+
+    """
+
+    # POST is left out of the retried methods so an order is never placed twice
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def espa_api(endpoint, verb='get', body=None, uauth=None, session=None):
     """
     A simple way suggested by USGS to interact with the ESPA Json rest API
 
@@ -56,7 +326,8 @@ def espa_api(endpoint, verb='get', body=None, uauth=None):
 
     host = 'https://espa.cr.usgs.gov/api/v1/'
     auth_tup = uauth
-    response = getattr(requests, verb)(host + endpoint, auth=auth_tup, json=body)
+    http = session if session is not None else requests
+    response = getattr(http, verb)(host + endpoint, auth=auth_tup, json=body)
     print('{} {}'.format(response.status_code, response.reason))
     data = response.json()
 
@@ -73,41 +344,133 @@ def espa_api(endpoint, verb='get', body=None, uauth=None):
         return data
 
 
+def _record_download(store, order_id, name):
+    """
+    Build a callback recording a finished download in the job state store.
+
+    """
+
+    def done(result):
+        local_file, md5sum = result
+        size = os.path.getsize(local_file) if os.path.isfile(local_file) \
+            else None
+        store.record_download(order_id, name, local_file, size, md5sum)
+    return done
+
+
 def check_n_download(ordered_items_to_download, order_id, data_dir, username,
-                     password):
+                     password, pool, session=None, store=None):
     """
-    Check the individual ordered items: download if complete, otherwise keep
-    checking every 5 mins
+    Check the individual ordered items once: queue the download of the
+    complete ones and report the rest as pending
 
-    :param ordered_items_to_download: a list of scenes to check and download
+    :param ordered_items_to_download: a list of scenes to check and download,
+                                      None for every item of the order
     :param order_id: the order id
-    :param data_dir: folder to store downloaded data
+    :param data_dir: folder to store downloaded data, or a dictionary of
+                     folders keyed by scene for orders spanning path/rows
     :param username: the username used to access espa
     :param password: the password used to access espa
+    :param pool: the :class:`download_pool.DownloadPool` fetching the items
+    :param session: an optional shared :class:`requests.Session`
+    :param store: an optional :class:`job_state.JobStore` recording item
+                  status and downloads; items it holds as downloaded are
+                  skipped
+
+    :returns: the items still pending, or None if the order status could not
+              be retrieved
 
     """
 
-    print('Items to check: ' + str(len(ordered_items_to_download)))
+    item_status_resp = espa_api('item-status/{0}'.format(order_id),
+                                uauth=(username, password), session=session)
+    if item_status_resp is None:
+        return None
+
+    if ordered_items_to_download is None and isinstance(data_dir, dict):
+        ordered_items_to_download = data_dir.keys()
+    if ordered_items_to_download is not None:
+        ordered_items_to_download = set(ordered_items_to_download)
     items_not_complete = []
 
-    item_status_resp = espa_api('item-status/{0}'.format(order_id),
-                                uauth=(username, password))
     for item in item_status_resp[order_id]:
-        if item['name'] in ordered_items_to_download:
+        if ordered_items_to_download is None or \
+                item['name'] in ordered_items_to_download:
+            item_dir = data_dir[item['name']] if isinstance(data_dir, dict) \
+                else data_dir
+            dload_url = item.get('product_dload_url')
+            if store is not None:
+                if store.is_downloaded(order_id, item['name']):
+                    continue
+                store.update_item(order_id, item['name'], item['status'],
+                                  dload_url, item_dir)
+
             if item['status'] == 'complete':
-                dload_url = item.get('product_dload_url')
-                download_file(dload_url, data_dir)
+                on_done = _record_download(store, order_id, item['name']) \
+                    if store is not None else None
+                pool.submit(dload_url, item_dir, on_done=on_done,
+                            checksum_url=item.get('cksum_download_url'),
+                            scene_name=item['name'])
+            elif item['status'] in UNAVAILABLE_STATUSES:
+                print('Item {0} is {1}: {2}'.format(item['name'], item['status'],
+                                                    item.get('note', '')))
             else:
                 items_not_complete.append(item['name'])
 
-    print ('Items still pending: ' + str(len(items_not_complete)))
-    if len(items_not_complete) > 0:
-        time.sleep(300)
-        print('check status again after 5 mins')
-        check_n_download(items_not_complete, order_id, data_dir, username, password)
+    print('Order {0}: items still pending: {1}'.format(order_id,
+                                                       len(items_not_complete)))
+    return items_not_complete
 
 
-def start_check_download(order_id, data_dir, username, password):
+def poll_orders(order_id_path_list, username, password, pool, session=None,
+                min_interval=60, max_interval=900, backoff=2.0, store=None):
+    """
+    Poll all the orders in one loop, queueing each item for download as soon
+    as it is complete, until every item has been dispatched
+
+    :param order_id_path_list: a list of (order id, data folder) tuples, the
+                               data folder being a dictionary of folders
+                               keyed by scene for orders spanning path/rows,
+                               or None to take the folders from the store;
+                               folders the store holds for every item of an
+                               order take precedence
+    :param username: the username used to access espa
+    :param password: the password used to access espa
+    :param pool: the :class:`download_pool.DownloadPool` fetching the items
+    :param session: an optional shared :class:`requests.Session`
+    :param min_interval: the shortest time between polls of an order in
+                         seconds
+    :param max_interval: the longest time between polls of an order in
+                         seconds
+    :param backoff: the factor the polling interval grows by while an order
+                    makes no progress
+    :param store: an optional :class:`job_state.JobStore`; only the items it
+                  does not hold as downloaded are polled
+
+    """
+
+    def check(order_id, items, data_dir):
+        return check_n_download(items, order_id, data_dir, username, password,
+                                pool, session, store)
+
+    poller = OrderPoller(check, min_interval=min_interval,
+                         max_interval=max_interval, backoff=backoff)
+    for order_id, data_dir in order_id_path_list:
+        items = store.pending_items(order_id) if store is not None else None
+        if store is not None:
+            item_dirs = store.item_data_dirs(order_id)
+            if data_dir is None or (item_dirs and all(item_dirs.values())):
+                data_dir = item_dirs
+        if items == []:
+            print('Already downloaded: ' + order_id)
+            continue
+        print('Processing order: ' + order_id)
+        poller.add_order(order_id, data_dir, items)
+    poller.run()
+
+
+def start_check_download(order_id, data_dir, username, password, pool,
+                         session=None):
     """
     Start to check the individual ordered items
 
@@ -115,17 +478,16 @@ def start_check_download(order_id, data_dir, username, password):
     :param data_dir: folder to store downloaded data
     :param username: the username used to access espa
     :param password: the password used to access espa
+    :param pool: the :class:`download_pool.DownloadPool` fetching the items
+    :param session: an optional shared :class:`requests.Session`
 
     """
-    print('Processing order: ' + order_id)
-    item_status_resp = espa_api('item-status/{0}'.format(order_id),
-                                uauth=(username, password))
-    print('Initial size of order:' + str(len(item_status_resp[order_id])))
-    check_n_download([x['name'] for x in item_status_resp[order_id]], order_id,
-                     data_dir, username, password)
+
+    poll_orders([(order_id, data_dir)], username, password, pool, session)
 
 
-def define_order(scene_list, desired_sensors_list, username, password):
+def define_order(scene_list, desired_sensors_list, username, password,
+                 session=None):
     """
     Defind the order based on requsted scenes.
 
@@ -133,6 +495,7 @@ def define_order(scene_list, desired_sensors_list, username, password):
     :param desired_sensors_list: list of desired sensors
     :param username: the username used to access espa
     :param password: the password used to access espa
+    :param session: an optional shared :class:`requests.Session`
 
     :returns: the order dictionary
 
@@ -145,7 +508,7 @@ def define_order(scene_list, desired_sensors_list, username, password):
     }
 
     available_products = espa_api('available-products', body=request_data,
-                                  uauth=(username, password))
+                                  uauth=(username, password), session=session)
 
     filtered_order = {}
 
@@ -187,13 +550,14 @@ def define_order(scene_list, desired_sensors_list, username, password):
     return filtered_order
 
 
-def submit_order(order, userNM, passWD):
+def submit_order(order, userNM, passWD, session=None):
     """
     Submit the defined order.
 
     :param order: the order dictionary
     :param userNM: the username used to access espa
     :param passWD: the password used to access espa
+    :param session: an optional shared :class:`requests.Session`
 
     :returns: the order id
 
@@ -201,7 +565,7 @@ def submit_order(order, userNM, passWD):
 
     print ('POST /api/v1/order')
     post_resp = espa_api('order', verb='post', body=order,
-                         uauth=(userNM, passWD))
+                         uauth=(userNM, passWD), session=session)
     orderid = post_resp['orderid']
 
     return orderid
@@ -219,85 +583,141 @@ def extract_products(fn, path_row, ymd1, ymd2):
 
     """
 
-    lines = [line.strip() for line in open(fn).readlines() if path_row in line]
-    result = []
-    for line in lines:
-        if ymd1 <= line.split('_')[3] <= ymd2: result.append(line)
-    return result
+    date_range = '{0}_{1}'.format(ymd1, ymd2)
+    return query_products(fn, [path_row], [date_range])[(path_row, date_range)]
 
 
-def get_latest_csv_from_usgs(csv_url, output_dir):
+def get_latest_csv_from_usgs(csv_url, output_dir, session=None):
     """
-    Download the text archive files from USGS website to an output folder and
-    unzip them.
+    Download the compressed text archive files from USGS website to an output
+    folder. The archive is left compressed; it is read through
+    :func:`bulk_metadata.open_bulk_metadata` one chunk at a time.
 
     :param csv_url: USGS website
     :param output_dir: the output folder
+    :param session: an optional shared :class:`requests.Session`
 
-    :returns: the unzipped text file
+    :returns: the gzipped text file
 
     """
 
-    local_zip_file = download_file(csv_url, output_dir)
+    return download_file(csv_url, output_dir, session=session)
 
-    # unzip
-    inF = gzip.open(local_zip_file, 'rb')
-    print("Unzipping " + local_zip_file)
-    out_file = local_zip_file.replace('.gz', '')
-    outF = open((out_file), 'wb')
-    outF.write(inF.read())
-    inF.close()
-    outF.close()
 
-    return out_file
+def remote_file_validators(url, validators=None, session=None):
+    """
+    Ask the server whether a file changed since it was last fetched, using a
+    conditional HEAD request.
+
+    :param url: the file url
+    :param validators: the ETag/Last-Modified values recorded at the last
+                       fetch, if any
+    :param session: an optional shared :class:`requests.Session`
 
+    :returns: the current ETag/Last-Modified values, or None if the file is
+              unchanged
 
-def produce_id_file(csv_url, root_folder, product_id_filename):
+    """
+
+    validators = validators or {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    http = session if session is not None else requests
+    r = http.head(url, headers=headers, allow_redirects=True)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+
+    current = {'etag': r.headers.get('ETag'),
+               'last_modified': r.headers.get('Last-Modified')}
+    # some servers ignore conditional headers, so compare the values as well
+    if (current['etag'] and current['etag'] == validators.get('etag')) or \
+            (not current['etag'] and current['last_modified'] and
+             current['last_modified'] == validators.get('last_modified')):
+        return None
+    return current
+
+
+def produce_id_file(csv_url, root_folder, product_id_filename, session=None,
+                    incremental=False):
     """
     Download the text archive files from USGS websites for all landsats to an
-    output folder, unzip them, and produce a simplified csv file with only
-    product id combining all the landsats.
+    output folder and stream them into a simplified csv file with only
+    product id combining all the landsats. The archives are parsed
+    concurrently, one worker process each.
+
+    In incremental mode only the archives changed since the last refresh are
+    downloaded, and only their new product ids are merged into the existing
+    product id file. The ETag/Last-Modified values of each archive are kept
+    in ``catalogue_state.json`` next to the product id file. A full rebuild
+    neither asks for nor records them, so the first incremental refresh
+    after it fetches every archive once more.
 
     :param csv_url: a list of USGS website
     :param root_folder: the output folder
     :param product_id_filename: the target name of the product id list
+    :param session: an optional shared :class:`requests.Session`
+    :param incremental: refresh an existing product id file rather than
+                        rebuild it
 
     :returns: the produced product id file
 
     """
 
-    csv_list = []
+    output_csv = pjoin(root_folder, product_id_filename)
+    state_path = pjoin(root_folder, 'catalogue_state.json')
+    incremental = incremental and os.path.exists(output_csv)
+    state = load_refresh_state(state_path) if incremental else {}
+
+    refresh = []
     for a_csv_url in csv_url:
-        a_csv = get_latest_csv_from_usgs(a_csv_url, root_folder)
-        csv_list.append(a_csv)
+        if not incremental:
+            # a full rebuild fetches every archive, no need to ask the server
+            refresh.append((a_csv_url, None))
+            continue
+        validators = remote_file_validators(a_csv_url, state.get(a_csv_url),
+                                            session)
+        if validators is None:
+            print('Unchanged since last refresh: ' + a_csv_url)
+        else:
+            refresh.append((a_csv_url, validators))
 
-    output_csv = pjoin(root_folder, product_id_filename)
+    csv_list = []
+    for a_csv_url, validators in refresh:
+        a_csv = get_latest_csv_from_usgs(a_csv_url, root_folder, session)
+        csv_list.append(a_csv)
+    part_list = [a_csv + '.ids' for a_csv in csv_list]
+
+    if csv_list:
+        with ProcessPoolExecutor(max_workers=len(csv_list)) as executor:
+            for a_part, count in executor.map(extract_product_ids, csv_list,
+                                              part_list):
+                print('Extracted {0} product ids into {1}'.format(count, a_part))
+
+    if incremental:
+        for a_part in part_list:
+            count = merge_product_ids(output_csv, a_part)
+            print('Merged {0} new product ids from {1}'.format(count, a_part))
+            os.remove(a_part)
+    else:
+        with open(output_csv, 'w') as h:
+            h.write('LANDSAT_PRODUCT_ID,CLOUD_COVER,CLOUD_COVER_LAND,'
+                    'MIN_LAT,MAX_LAT,MIN_LON,MAX_LON\n')
+            for a_part in part_list:
+                with open(a_part, 'r') as f:
+                    shutil.copyfileobj(f, h)
+                os.remove(a_part)
+        build_catalogue_index(output_csv)
+
+    if incremental:
+        for a_csv_url, validators in refresh:
+            state[a_csv_url] = validators
+        save_refresh_state(state_path, state)
 
-    handles = [open(a_csv, 'r') for a_csv in csv_list]
-    readers = [csv.reader(f, delimiter=',') for f in handles]
-
-    with open(output_csv, 'w') as h:
-        writer = csv.writer(h, delimiter=',', lineterminator='\n')
-        writer.writerow(['LANDSAT_PRODUCT_ID'])
-        i = 0
-        for reader in readers:
-            for row in reader:
-                if i == 0:
-                    # ls5
-                    id_field = 26
-                elif i == 1:
-                    # ls7
-                    id_field = 29
-                else:
-                    # ls8
-                    id_field = 31
-
-                if row[id_field][-2:] != 'RT' and row[id_field] != 'LANDSAT_PRODUCT_ID':
-                    writer.writerow([row[id_field]])
-            i += 1
-
-    for f in handles:
-        f.close()
     print('Saved LANDSAT bulk metadata in: ' + output_csv)
     return output_csv
 
@@ -326,6 +746,99 @@ def create_sub_output_folder(root, sub_folder):
     return output
 
 
+def create_download_session(config):
+    """
+    Create the shared HTTP session from the optional ``Download`` section of
+    the configuration file.
+
+    :param config: the parsed configuration
+
+    :returns: a :class:`requests.Session`
+
+    """
+
+    return create_session(
+        pool_size=config.getint('Download', 'http_pool_size', fallback=10),
+        max_retries=config.getint('Download', 'http_retries', fallback=5),
+        backoff_factor=config.getfloat('Download', 'http_backoff', fallback=2))
+
+
+def create_unpack_pipeline(config):
+    """
+    Create the pipeline unpacking scenes as they are downloaded, if enabled
+    in the optional ``Unpack`` section of the configuration file.
+
+    :param config: the parsed configuration
+
+    :returns: a :class:`unpack_scenes.UnpackPipeline`, or None
+
+    """
+
+    if not config.getboolean('Unpack', 'pipeline', fallback=False):
+        return None
+
+    unpack_folder = config.get('Process', 'unpack_folder')
+    workers = config.getint('Unpack', 'workers', fallback=2)
+    queue_size = config.getint('Unpack', 'queue_size', fallback=8)
+    bands = config.get('Unpack', 'bands', fallback=None)
+    bands = bands.split() if bands else None
+    cog = config.getboolean('Unpack', 'cog', fallback=False)
+    manifest = config.get('Unpack', 'manifest', fallback=None)
+    index = config.get('Unpack', 'index', fallback=None)
+    print('unpacking downloads to {0} with {1} worker(s), bands: {2}{3}'.format(
+        unpack_folder, workers, ' '.join(bands) if bands else 'all',
+        ', as Cloud-Optimized GeoTIFFs' if cog else ''))
+    return UnpackPipeline(unpack_folder, workers=workers, queue_size=queue_size,
+                          bands=bands, cog=cog, manifest=manifest, index=index)
+
+
+def _unpack_download(unpacker):
+    """
+    Build a callback handing every downloaded archive to the unpack pipeline.
+
+    """
+
+    def done(result):
+        local_file = result[0]
+        if local_file.endswith('.tar.gz'):
+            unpacker.submit(local_file)
+    return done
+
+
+def create_download_pool(config, session=None, unpacker=None):
+    """
+    Create the download pool from the optional ``Download`` section of the
+    configuration file. Items already downloaded, or already unpacked to the
+    optional ``unpack_folder``, are not fetched again.
+
+    :param config: the parsed configuration
+    :param session: an optional shared :class:`requests.Session`
+    :param unpacker: an optional :class:`unpack_scenes.UnpackPipeline`
+                     receiving each archive as soon as it is downloaded
+
+    :returns: a :class:`download_pool.DownloadPool`
+
+    """
+
+    max_workers = config.getint('Download', 'max_workers', fallback=4)
+    max_per_host = config.getint('Download', 'max_per_host', fallback=4)
+    max_bandwidth = config.getfloat('Download', 'max_bandwidth', fallback=0)
+
+    unpack_folder = config.get('Process', 'unpack_folder', fallback=None)
+
+    print('downloading with {0} worker(s), {1} per host, bandwidth ceiling: '
+          '{2}'.format(max_workers, max_per_host,
+                       '{0} MB/s'.format(max_bandwidth) if max_bandwidth
+                       else 'none'))
+    return DownloadPool(partial(download_item, session=session,
+                                unpack_folder=unpack_folder),
+                        max_workers=max_workers,
+                        max_per_host=max_per_host,
+                        max_bandwidth=max_bandwidth * 1024 * 1024,
+                        on_complete=_unpack_download(unpacker)
+                        if unpacker is not None else None)
+
+
 def timer(f):
     """
     Basic timing functions for entire process
@@ -367,11 +880,16 @@ def run():
     config.read(configFile)
 
     download_catalogue = config.getboolean('Process', 'download_catalogue')
+    incremental_catalogue = config.getboolean('Process', 'incremental_catalogue',
+                                              fallback=False)
     product_id_filename = config.get('Process', 'product_id_filename')
     desired_sensors_list = config.get('Process', 'desired_sensors_list').split(' ')
     date_range_list = config.get('Process', 'date_range_list').split(' ')
     path_row_list = config.get('Process', 'path_row_list').split(' ')
     root_folder = config.get('Process', 'root_folder')
+    max_scenes_per_order = config.getint('Process', 'max_scenes_per_order',
+                                         fallback=5000)
+    max_cloud_cover = config.getfloat('Process', 'max_cloud_cover', fallback=None)
 
     csv_url = ['https://landsat.usgs.gov/landsat/metadata_service/'
                'bulk_metadata_files/LANDSAT_TM_C1.csv.gz',
@@ -380,9 +898,18 @@ def run():
                'https://landsat.usgs.gov/landsat/metadata_service/'
                'bulk_metadata_files/LANDSAT_8_C1.csv.gz']
 
+    if config.getboolean('Unpack', 'pipeline', fallback=False) and \
+            config.getboolean('Unpack', 'cog', fallback=False):
+        # fail before ordering rather than on every unpacked scene
+        require_cog()
+
+    session = create_download_session(config)
+
     if download_catalogue:
         print('downloading latest LANDSAT bulk metadata file')
-        product_id_path = produce_id_file(csv_url, root_folder, product_id_filename)
+        product_id_path = produce_id_file(csv_url, root_folder,
+                                          product_id_filename, session,
+                                          incremental_catalogue)
     else:
         print('skipping download of latest LANDSAT metadata file')
         product_id_path = pjoin(root_folder, product_id_filename)
@@ -397,40 +924,68 @@ def run():
     username = getpass.getpass(prompt='username for ESPA: ')
     password = getpass.getpass(prompt='password for ESPA: ')
 
+    store = JobStore(config.get('Process', 'state_db',
+                                fallback=pjoin(root_folder, 'jobs.db')))
     order_id_path_list = []
+    products = query_products(product_id_path, path_row_list, date_range_list,
+                              max_cloud_cover)
 
+    data_dirs = {}
     for path_row in path_row_list:
         data_dir = pjoin(root_folder, 'L2/gz/{}'.format(path_row))
         if not os.path.exists(data_dir):
             data_dir = create_sub_output_folder(root_folder,
                                                 'L2/gz/{}'.format(path_row))
-
-        for date_range in date_range_list:
-            date_start = date_range.split('_')[0]
-            date_end = date_range.split('_')[1]
-            product_list = extract_products(product_id_path, path_row,
-                                            date_start, date_end)
-            order = define_order(product_list, desired_sensors_list, username, password)
-            order_no = 0
-            found_sensors = []
-            for sensor in desired_sensors_list:
-                if sensor in order:
-                    found_sensors.append(sensor)
-                    order_no += len(order[sensor]['inputs'])
-            if len(found_sensors) > 0:
-                print ('ordering  ' + str(order_no) + ' scenes(s) for path/row: ' + path_row + ', date range: ' +
-                       date_range + ', sensors: ' + str(found_sensors))
-                order_id = submit_order(order, username, password)
-                order_id_path_list.append((order_id, data_dir))
-            else:
-                print('No items found for for path/row: ' + path_row + ', date range: ' + date_range + ', sensors: ' +
-                      str(desired_sensors_list))
-
-    for order_id_path in order_id_path_list:
-        start_check_download(order_id_path[0], order_id_path[1], username, password)
-
+        data_dirs[path_row] = data_dir
+
+    for planned_dirs in plan_orders(products, data_dirs, max_scenes_per_order):
+        order = define_order(list(planned_dirs.keys()), desired_sensors_list,
+                             username, password, session)
+        scenes = ordered_scenes(order, desired_sensors_list)
+        order_dirs = dict((scene, planned_dirs[scene]) for scene in scenes)
+        order_path_rows = sorted(set(scene.split('_')[2] for scene in scenes))
+        if len(scenes) > 0:
+            print('ordering  ' + str(len(scenes)) + ' scenes(s) for ' +
+                  str(len(order_path_rows)) + ' path/row(s): ' +
+                  ' '.join(order_path_rows))
+            order_id = submit_order(order, username, password, session)
+            store.add_order(order_id, None, ' '.join(order_path_rows),
+                            ' '.join(date_range_list))
+            store.add_items(order_id, order_dirs)
+            order_id_path_list.append((order_id, order_dirs))
+        else:
+            print('No items found for ' + str(len(planned_dirs)) + ' scene(s), sensors: ' +
+                  str(desired_sensors_list))
+
+    unpacker = create_unpack_pipeline(config)
+    pool = create_download_pool(config, session, unpacker)
+    poll_orders(order_id_path_list, username, password, pool, session,
+                min_interval=config.getfloat('Download', 'poll_min_interval',
+                                             fallback=60),
+                max_interval=config.getfloat('Download', 'poll_max_interval',
+                                             fallback=900),
+                backoff=config.getfloat('Download', 'poll_backoff',
+                                        fallback=2),
+                store=store)
+
+    failed = pool.wait()
+    pool.shutdown()
+    store.close()
+    for url, data_dir in failed:
+        log.error("Failed to download {0} to {1}".format(url, data_dir))
+    failed_unpacks = unpacker.wait() if unpacker is not None else []
+    for tar_filepath in failed_unpacks:
+        log.error("Failed to unpack {0}".format(tar_filepath))
+
+    if failed or failed_unpacks:
+        log.error("Completed with {0} failed download(s) and {1} failed "
+                  "unpack(s)".format(len(failed), len(failed_unpacks)))
+        print('{0} download(s) and {1} unpack(s) failed, see {2}'.format(
+            len(failed), len(failed_unpacks), logfile))
+        return 1
     log.info("Successfully completed!")
+    return 0
 
 
 if __name__ == '__main__':
-    run()
+    sys.exit(run())
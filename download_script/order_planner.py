@@ -0,0 +1,65 @@
+"""
+:mod:`order_planner` - Batch the scenes of many path/rows into ESPA orders.
+===============================================================================
+
+Rather than one order per path/row and date range, the product ids of all
+path/rows are packed into as few orders as the per-order scene limit allows.
+Each order carries the download folder of every scene in it, as the scenes of
+one order now belong to many path/rows.
+
+"""
+
+
+def plan_orders(products, data_dirs, max_scenes_per_order=5000):
+    """
+    Pack product ids into orders of at most ``max_scenes_per_order`` scenes,
+    keeping the scenes of a path/row together where possible.
+
+    :param products: product id lists keyed by (path/row, date range), as
+                     returned by :func:`catalogue.query_products`
+    :param data_dirs: download folders keyed by path/row
+    :param max_scenes_per_order: the most scenes put in one order
+
+    :returns: a list of dictionaries, one per order, mapping each product id
+              to its download folder
+
+    """
+
+    batches = []
+    batch = {}
+    seen = set()
+
+    for (path_row, date_range), product_list in products.items():
+        for product_id in product_list:
+            # overlapping date ranges select some scenes twice
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+
+            batch[product_id] = data_dirs[path_row]
+            if len(batch) == max_scenes_per_order:
+                batches.append(batch)
+                batch = {}
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def ordered_scenes(order, sensors):
+    """
+    List the scenes an order definition actually requests, which excludes
+    the problem scenes :func:`level2_order_download.define_order` removed.
+
+    :param order: the order dictionary
+    :param sensors: the desired sensors
+
+    :returns: a list of product ids
+
+    """
+
+    scenes = []
+    for sensor in sensors:
+        if isinstance(order.get(sensor), dict):
+            scenes.extend(order[sensor].get('inputs', []))
+    return scenes
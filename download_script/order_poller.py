@@ -0,0 +1,98 @@
+"""
+:mod:`order_poller` - Poll many ESPA orders in one loop and hand completed
+items to the download pool as soon as they are ready.
+===============================================================================
+
+"""
+
+import time
+
+
+class OrderPoller(object):
+    """
+    Poll all outstanding orders in a single loop. Each order keeps its own
+    polling interval: it drops back to ``min_interval`` whenever a poll finds
+    newly completed items and grows by ``backoff`` up to ``max_interval``
+    while nothing changes, so one slow order never holds up another.
+
+    :param check_func: callable ``check_func(order_id, items, data_dir)``
+                       dispatching the complete items of an order and
+                       returning the items still pending (``items`` is None
+                       for every item of the order), or None if the status
+                       could not be retrieved
+    :param min_interval: the shortest time between polls of an order in
+                         seconds
+    :param max_interval: the longest time between polls of an order in
+                         seconds
+    :param backoff: the factor the interval grows by after an idle poll
+
+    """
+
+    def __init__(self, check_func, min_interval=60, max_interval=900,
+                 backoff=2.0):
+        self.check_func = check_func
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.orders = {}
+
+    def add_order(self, order_id, data_dir, items=None):
+        """
+        Start polling an order.
+
+        :param order_id: the order id
+        :param data_dir: folder to store downloaded data
+        :param items: the item names to wait for, None for the whole order
+
+        """
+
+        self.orders[order_id] = {'data_dir': data_dir,
+                                 'items': items,
+                                 'interval': self.min_interval,
+                                 'next_poll': time.time()}
+
+    def poll(self, order_id):
+        """
+        Poll one order and schedule its next poll.
+
+        :param order_id: the order id
+
+        """
+
+        order = self.orders[order_id]
+        pending = self.check_func(order_id, order['items'], order['data_dir'])
+
+        if pending is not None and len(pending) == 0:
+            print('Order complete: ' + order_id)
+            del self.orders[order_id]
+            return
+
+        if pending is not None and (order['items'] is None or
+                                    len(pending) < len(order['items'])):
+            order['interval'] = self.min_interval
+        else:
+            order['interval'] = min(order['interval'] * self.backoff,
+                                    self.max_interval)
+        if pending is not None:
+            order['items'] = pending
+        order['next_poll'] = time.time() + order['interval']
+
+    def run(self):
+        """
+        Poll until every item of every order has been dispatched.
+
+        """
+
+        while self.orders:
+            now = time.time()
+            for order_id in [o for o, order in self.orders.items()
+                             if order['next_poll'] <= now]:
+                self.poll(order_id)
+
+            if self.orders:
+                next_poll = min(order['next_poll']
+                                for order in self.orders.values())
+                wait = max(next_poll - time.time(), 0)
+                print('{0} order(s) outstanding, next check in {1:.0f} '
+                      's'.format(len(self.orders), wait))
+                time.sleep(wait)
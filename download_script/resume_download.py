@@ -1,144 +1,131 @@
 #!/bin/env python
 
-import time
-import os, json, requests, getpass
+import getpass
 import argparse
 
-try:
-    from urllib.parse import urlparse, urljoin
-except ImportError:
-    from urlparse import urlparse, urljoin
+from download_pool import DownloadPool
+from functools import partial
+from job_state import JobStore
+from unpack_scenes import UnpackPipeline
+from level2_order_download import create_session, download_item, poll_orders, \
+    _unpack_download
 
 
-def download_file(url, output_dir):
+def resume_orders(store, order_ids, target_folder):
     """
-    Download the text archive files from USGS website to an output folder.
+    Get the orders to resume from the job state database. Orders listed in
+    the jobs file but not in the database are recorded to go to the target
+    folder; orders already in the database keep their recorded folders.
 
-    :param url: USGS website
-    :param output_dir: the output folder
+    :param store: the :class:`job_state.JobStore`
+    :param order_ids: the order ids of the jobs file
+    :param target_folder: the folder of the orders only in the jobs file
 
-    :returns: the downloaded file
+    :returns: a list of (order id, data folder) tuples, the data folder None
+              where it is to be taken per item from the store
 
     """
 
-    local_filename = os.path.join(output_dir, url.split('/')[-1])
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-    return local_filename
-
-
-def espa_api(endpoint, verb='get', body=None, uauth=None):
-    """
-    A simple way suggested by USGS to interact with the ESPA Json rest API
-
-    """
-
-    host = 'https://espa.cr.usgs.gov/api/v1/'
-    auth_tup = uauth
-    response = getattr(requests, verb)(host + endpoint, auth=auth_tup, json=body)
-    print('{} {}'.format(response.status_code, response.reason))
-    data = response.json()
-
-    if isinstance(data, dict):
-        messages = data.pop("messages", None)
-        if messages:
-            print(json.dumps(messages, indent=4))
-    try:
-        response.raise_for_status()
-    except Exception as e:
-        print (e)
-        return None
-    else:
-        return data
-
-
-def check_n_download(ordered_items_to_download, order_id, data_dir, username,
-                     password):
-    """
-    Check the individual ordered items: download if complete, otherwise keep
-    checking every 5 mins
-
-    :param ordered_items_to_download: a list of scenes to check and download
-    :param order_id: the order id
-    :param data_dir: folder to store downloaded data
-    :param username: the username used to access espa
-    :param password: the password used to access espa
-
-    """
-
-    print('Items to check: ' + str(len(ordered_items_to_download)))
-    items_not_complete = []
-
-    item_status_resp = espa_api('item-status/{0}'.format(order_id),
-                                uauth=(username, password))
-    for item in item_status_resp[order_id]:
-        if item['name'] in ordered_items_to_download:
-            if item['status'] == 'complete':
-                dload_url = item.get('product_dload_url')
-                download_file(dload_url, data_dir)
-            else:
-                items_not_complete.append(item['name'])
-
-    print ('Items still pending: ' + str(len(items_not_complete)))
-    if len(items_not_complete) > 0:
-        time.sleep(300)
-        print('check status again after 5 mins')
-        check_n_download(items_not_complete, order_id, data_dir, username, password)
-
-
-def start_check_download(order_id, data_dir, username, password):
-    """
-    Start to check the individual ordered items
-
-    :param order_id: the order id
-    :param data_dir: folder to store downloaded data
-    :param username: the username used to access espa
-    :param password: the password used to access espa
-
-    """
-    print('Processing order: ' + order_id)
-    item_status_resp = espa_api('item-status/{0}'.format(order_id),
-                                uauth=(username, password))
-    print('Initial size of order:' + str(len(item_status_resp[order_id])))
-    check_n_download([x['name'] for x in item_status_resp[order_id]], order_id,
-                     data_dir, username, password)
+    for order_id in order_ids:
+        if not store.has_order(order_id):
+            store.add_order(order_id, target_folder)
+    return store.outstanding_orders()
 
 
 def resume_download():
     """
-    So this is a fairly unsophisticated hack of the main download script for resuming downloads from ESPA
-    It could be augmented in the following ways:
-    1. Remove the copy-pasta and move the common code to a different class
-    2. This could be altered to include the target paths per order, although this is a significant amount of work when
-    unpack_scenes does a lot of that magic for you
+    Resume downloads from ESPA. With a job state database the outstanding
+    orders, their target paths and the items already downloaded are taken
+    from the database; otherwise every order id in the jobs file is checked
+    again and downloaded to the one target folder.
 
     """
     parser = argparse.ArgumentParser(description='Resume unfinished USGS order submission')
-    parser.add_argument('target_folder', help='path to save your gzipped/tarred USGS Landsat scenes')
-    parser.add_argument('jobs_file', help='file containing your ESPA order ids')
+    parser.add_argument('target_folder', nargs='?', help='path to save your gzipped/tarred USGS Landsat scenes')
+    parser.add_argument('jobs_file', nargs='?', help='file containing your ESPA order ids')
+    parser.add_argument('--state-db',
+                        help='job state database written by level2_order_download.py')
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help='number of items downloaded in parallel')
+    parser.add_argument('--max-per-host', type=int, default=4,
+                        help='maximum simultaneous connections to a single host')
+    parser.add_argument('--max-bandwidth', type=float, default=0,
+                        help='aggregate bandwidth ceiling in MB/s, 0 for unlimited')
+    parser.add_argument('--unpack-folder',
+                        help='path to your unpacked scenes; scenes found there are not downloaded again')
+    parser.add_argument('--unpack-pipeline', action='store_true',
+                        help='unpack each scene to --unpack-folder as soon as it is downloaded')
+    parser.add_argument('--unpack-workers', type=int, default=2,
+                        help='number of unpacking processes for --unpack-pipeline')
+    parser.add_argument('--unpack-bands', nargs='+', default=None,
+                        help='bands extracted by --unpack-pipeline (default: all)')
+    parser.add_argument('--unpack-cog', action='store_true',
+                        help='rewrite the bands unpacked by --unpack-pipeline as '
+                             'Cloud-Optimized GeoTIFFs (requires rasterio)')
+    parser.add_argument('--unpack-manifest', default=None,
+                        help='file collecting the datacube dataset documents of the scenes '
+                             'unpacked by --unpack-pipeline')
+    parser.add_argument('--unpack-index', default=None,
+                        help='SQLite index of the statistics sidecars of the scenes '
+                             'unpacked by --unpack-pipeline')
+    parser.add_argument('--http-pool-size', type=int, default=10,
+                        help='pooled keep-alive connections per host')
     args = parser.parse_args()
     target_folder = args.target_folder
     jobs_file = args.jobs_file
+    if not args.state_db and not jobs_file:
+        parser.error('either target_folder and jobs_file or --state-db is required')
+    if args.unpack_pipeline and not args.unpack_folder:
+        parser.error('--unpack-pipeline requires --unpack-folder')
     # define an empty list
     order_ids = []
 
-    with open(jobs_file, 'r') as filehandle:
-        for line in filehandle:
-            # remove linebreak which is the last character of the string
-            order_id = line[:-1]
+    if jobs_file:
+        with open(jobs_file, 'r') as filehandle:
+            for line in filehandle:
+                # remove linebreak which is the last character of the string
+                order_id = line.strip()
+
+                # add item to the list
+                if len(order_id) > 0:
+                    order_ids.append(order_id)
 
-            # add item to the list
-            order_ids.append(order_id)
+    store = None
+    if args.state_db:
+        store = JobStore(args.state_db)
+        order_id_path_list = resume_orders(store, order_ids, target_folder)
+    else:
+        order_id_path_list = [(order_id, target_folder)
+                              for order_id in reversed(order_ids)]
 
     username = getpass.getpass(prompt='username for ESPA: ')
     password = getpass.getpass(prompt='password for ESPA: ')
 
-    for order_id in reversed(order_ids):
-        if len(order_id) > 0:
-            start_check_download(order_id, target_folder, username, password)
+    session = create_session(pool_size=args.http_pool_size)
+    unpacker = None
+    if args.unpack_pipeline:
+        unpacker = UnpackPipeline(args.unpack_folder, workers=args.unpack_workers,
+                                  bands=args.unpack_bands, cog=args.unpack_cog,
+                                  manifest=args.unpack_manifest,
+                                  index=args.unpack_index)
+    pool = DownloadPool(partial(download_item, session=session,
+                                unpack_folder=args.unpack_folder),
+                        max_workers=args.max_workers,
+                        max_per_host=args.max_per_host,
+                        max_bandwidth=args.max_bandwidth * 1024 * 1024,
+                        on_complete=_unpack_download(unpacker)
+                        if unpacker is not None else None)
+    poll_orders(order_id_path_list, username, password, pool, session,
+                store=store)
+
+    for url, data_dir in pool.wait():
+        print('failed to download: ' + url)
+    pool.shutdown()
+    if store is not None:
+        store.close()
+    if unpacker is not None:
+        for tar_filepath in unpacker.wait():
+            print('failed to unpack: ' + tar_filepath)
 
 
 if __name__ == '__main__':
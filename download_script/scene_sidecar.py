@@ -0,0 +1,286 @@
+#!/bin/env python
+"""
+:mod:`scene_sidecar` - Per-scene statistics and quicklooks, and an index of
+them.
+===============================================================================
+
+While a scene is unpacked, every band is summarised as soon as it is
+extracted, while it is still in the page cache: the flag fractions of
+``pixel_qa``, the min, max and mean of the other bands, and a decimated
+quicklook. They are written next to the bands, as ``<scene>_sidecar.json``
+and ``<scene>_quicklook.npz``, and collected in a SQLite index of scenes, so
+time series loaders can pre-select acquisitions (e.g. by clear fraction)
+without opening any raster.
+
+"""
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from tiff_band import TiffBand, band_statistics, pixel_qa_summary
+
+# every QUICKLOOK_STEP-th pixel of every QUICKLOOK_STEP-th row
+QUICKLOOK_STEP = 16
+
+FRACTIONS = ('clear', 'cloud', 'cloud_shadow', 'water', 'snow')
+
+
+def summarise_band(tif_path, scene_name, step=QUICKLOOK_STEP):
+    """
+    Summarise one band of a scene.
+
+    :param tif_path: the band GeoTIFF, uncompressed as unpacked
+    :param scene_name: the scene name the band file name starts with
+    :param step: the decimation factor of the quicklook
+
+    :returns: the band name (e.g. 'sr_band1'), its statistics (see
+              :func:`tiff_band.pixel_qa_summary` and
+              :func:`tiff_band.band_statistics`) and its quicklook array
+    :raises ValueError: if the band cannot be memory-mapped
+
+    """
+
+    band = TiffBand(tif_path)
+    name = os.path.splitext(os.path.basename(tif_path))[0][len(scene_name) + 1:]
+    statistics = pixel_qa_summary(band) if name == 'pixel_qa' else band_statistics(band)
+    return name, statistics, np.array(band.array[::step, ::step])
+
+
+def sidecar_path(scene_folder, scene_name=None):
+    """
+    Get the path of the sidecar of an unpacked scene.
+
+    :param scene_folder: the unpacked scene
+    :param scene_name: the scene name, defaults to the name of the folder
+
+    :returns: the sidecar, <scene folder>/<scene name>_sidecar.json
+
+    """
+
+    scene_folder = scene_folder.rstrip('/')
+    return os.path.join(scene_folder,
+                        (scene_name or os.path.basename(scene_folder)) + '_sidecar.json')
+
+
+def write_sidecar(scene_name, statistics, quicklooks, scene_folder,
+                  step=QUICKLOOK_STEP):
+    """
+    Write the sidecar and quicklook of a scene into its folder.
+
+    :param scene_name: the scene name
+    :param statistics: the statistics of each band keyed by band name, as
+                       returned by :func:`summarise_band`
+    :param quicklooks: the quicklook arrays keyed by band name
+    :param scene_folder: the scene folder, possibly still under a temporary
+                         name
+    :param step: the decimation factor of the quicklooks
+
+    :returns: the sidecar file
+
+    """
+
+    sidecar = {'scene': scene_name, 'bands': {}}
+    for name, band in statistics.items():
+        if name == 'pixel_qa':
+            sidecar.update(band)
+        else:
+            sidecar['bands'][name] = band
+    if quicklooks:
+        sidecar['quicklook'] = scene_name + '_quicklook.npz'
+        sidecar['quicklook_step'] = step
+        np.savez_compressed(os.path.join(scene_folder, sidecar['quicklook']),
+                            **quicklooks)
+    path = sidecar_path(scene_folder, scene_name)
+    with open(path, 'w') as f:
+        json.dump(sidecar, f, indent=4, sort_keys=True)
+    return path
+
+
+def scene_sidecar(scene_folder, step=QUICKLOOK_STEP):
+    """
+    Write the sidecar of a scene unpacked without one.
+
+    :param scene_folder: the unpacked scene
+    :param step: the decimation factor of the quicklooks
+
+    :returns: the sidecar file
+    :raises ValueError: if a band cannot be memory-mapped, e.g. after
+                        conversion to Cloud-Optimized GeoTIFF
+
+    """
+
+    scene_name = os.path.basename(os.path.normpath(scene_folder))
+    statistics = {}
+    quicklooks = {}
+    for tif_path in sorted(glob.glob(os.path.join(scene_folder, scene_name + '_*.tif'))):
+        name, statistics[name], quicklooks[name] = summarise_band(tif_path, scene_name, step)
+    return write_sidecar(scene_name, statistics, quicklooks, scene_folder, step)
+
+
+class SceneIndex(object):
+    """
+    SQLite index of the sidecars of unpacked scenes. Safe to share between
+    threads.
+
+    :param db_path: the database file, created if missing
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(
+            'CREATE TABLE IF NOT EXISTS scenes ('
+            ' scene TEXT PRIMARY KEY, sensor TEXT, path_row TEXT,'
+            ' acquired TEXT, folder TEXT, pixels INTEGER, valid INTEGER,'
+            ' clear_fraction REAL, cloud_fraction REAL,'
+            ' cloud_shadow_fraction REAL, water_fraction REAL,'
+            ' snow_fraction REAL, bands TEXT, quicklook TEXT);'
+            'CREATE INDEX IF NOT EXISTS scenes_path_row'
+            ' ON scenes (path_row, acquired);')
+        self.conn.commit()
+
+    def add(self, scene_folder):
+        """
+        Index the sidecar of an unpacked scene, replacing any earlier entry.
+
+        :param scene_folder: the unpacked scene
+
+        :returns: True if the scene had a sidecar
+
+        """
+
+        path = sidecar_path(scene_folder)
+        if not os.path.isfile(path):
+            return False
+        with open(path) as f:
+            sidecar = json.load(f)
+        scene_folder = os.path.abspath(scene_folder)
+        # e.g. LC08_L1TP_041033_20200101_20200110_01_T1
+        fields = sidecar['scene'].split('_')
+        acquired = '{0}-{1}-{2}'.format(fields[3][:4], fields[3][4:6], fields[3][6:8])
+        quicklook = os.path.join(scene_folder, sidecar['quicklook']) \
+            if 'quicklook' in sidecar else None
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO scenes VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (sidecar['scene'], fields[0], fields[2], acquired,
+                               scene_folder, sidecar.get('pixels'), sidecar.get('valid'))
+                              + tuple(sidecar.get(name + '_fraction') for name in FRACTIONS)
+                              + (json.dumps(sidecar['bands'], sort_keys=True), quicklook))
+            self.conn.commit()
+        return True
+
+    def select(self, path_rows=None, time=None, sensors=None, min_clear=0):
+        """
+        Pre-select scenes by their sidecar.
+
+        :param path_rows: the path/rows, e.g. ['041033'], None for all
+        :param time: the (start, end) acquisition dates, as 'YYYY-MM-DD'
+                     strings, both ends included, None for all
+        :param sensors: the sensors, e.g. ['LC08', 'LE07'], None for all
+        :param min_clear: the least clear fraction of the valid pixels
+
+        :returns: a list of dictionaries, one per scene in acquisition order,
+                  with the columns of the index and the band statistics
+                  decoded
+
+        """
+
+        # scenes unpacked without pixel_qa have no fractions
+        sql = 'SELECT * FROM scenes WHERE ifnull(clear_fraction, 0) >= ?'
+        params = [min_clear]
+        for column, values in (('path_row', path_rows), ('sensor', sensors)):
+            if values is not None:
+                sql += ' AND {0} IN ({1})'.format(column, ', '.join('?' * len(values)))
+                params.extend(values)
+        if time is not None:
+            sql += ' AND acquired BETWEEN ? AND ?'
+            params.extend(time)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY acquired, scene', params).fetchall()
+        scenes = []
+        for row in rows:
+            scene = dict(row)
+            scene['bands'] = json.loads(scene['bands'])
+            scenes.append(scene)
+        return scenes
+
+
+def _scene_sidecar(scene_folder, step):
+    """
+    Write the sidecar of one scene in a worker process, reporting rather than
+    raising errors so one bad scene does not stop the others.
+
+    """
+
+    try:
+        return scene_sidecar(scene_folder, step), None
+    except Exception:
+        return None, '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                       sys.exc_info()[1])
+
+
+def sidecar_all(scene_folders, index=None, workers=None, step=QUICKLOOK_STEP):
+    """
+    Write the missing sidecars of many scenes concurrently and index them.
+
+    :param scene_folders: a list of unpacked scene folders
+    :param index: an optional scene index database
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+    :param step: the decimation factor of the quicklooks
+
+    :returns: a list of the scene folders without a sidecar
+
+    """
+
+    failed = []
+    index = SceneIndex(index) if index else None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_scene_sidecar, scene_folder, step), scene_folder)
+                       for scene_folder in scene_folders
+                       if not os.path.isfile(sidecar_path(scene_folder)))
+        for future in as_completed(futures):
+            scene_folder = futures[future]
+            path, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping: ' + scene_folder)
+                failed.append(scene_folder)
+            else:
+                print('sidecar {0} complete'.format(path))
+    if index is not None:
+        for scene_folder in scene_folders:
+            index.add(scene_folder)
+    return failed
+
+
+def scene_sidecars():
+    parser = argparse.ArgumentParser(
+        description='Write the missing sidecars of unpacked USGS Landsat scenes and index them.')
+    parser.add_argument('target_folder', help='path to your ungzipped/untarred USGS Landsat scenes')
+    parser.add_argument('--index', default=None,
+                        help='SQLite index of the scene sidecars, created if missing')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of scenes read in parallel (default: number of CPUs)')
+    parser.add_argument('--step', type=int, default=QUICKLOOK_STEP,
+                        help='decimation factor of the quicklooks (default: {0})'.format(QUICKLOOK_STEP))
+    args = parser.parse_args()
+    scene_folders = [folder for folder in glob.glob(args.target_folder + '/*/*/')  # path/row/scene folders
+                     if not folder.rstrip('/').endswith('.tmp')]
+    sidecar_all(scene_folders, args.index, args.workers, args.step)
+
+
+if __name__ == '__main__':
+    scene_sidecars()
@@ -0,0 +1,135 @@
+"""
+:mod:`test_download_file` - Resumable downloads against a local HTTP
+stand-in server.
+===============================================================================
+
+Run with ``python -m unittest test_download_file`` from this folder.
+
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from level2_order_download import download_file
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Serves ``server.body`` with a strong ETag, honouring Range and If-Range
+    unless ``server.ignore_range`` is set. While ``server.drops`` is positive
+    a response advertises the full length but the connection is closed after
+    half of it.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body = server.body
+        etag = '"{0}"'.format(server.version)
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and not server.ignore_range and \
+                (if_range is None or if_range == etag):
+            start = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        payload = body[start:]
+        if server.drops > 0:
+            server.drops -= 1
+            self.wfile.write(payload[:len(payload) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(payload)
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        self.server.body = os.urandom(300000)
+        self.server.version = 1
+        self.server.drops = 0
+        self.server.ignore_range = False
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/scene.tar.gz'.format(self.server.server_port)
+        self.output_dir = tempfile.mkdtemp()
+        self.local_filename = os.path.join(self.output_dir, 'scene.tar.gz')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+
+    def _download(self):
+        return download_file(self.url, self.output_dir, chunk_size=4096)
+
+    def _read(self):
+        with open(self.local_filename, 'rb') as f:
+            return f.read()
+
+    def test_complete(self):
+        self.assertEqual(self._download(), self.local_filename)
+        self.assertEqual(self._read(), self.server.body)
+        self.assertEqual(os.listdir(self.output_dir), ['scene.tar.gz'])
+
+    def test_resume_after_disconnect(self):
+        self.server.drops = 2
+        self._download()
+        self.assertEqual(self._read(), self.server.body)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertNotIn('Range', self.server.requests[0])
+        self.assertEqual(self.server.requests[1]['If-Range'], '"1"')
+        self.assertEqual(self.server.requests[1]['Range'],
+                         'bytes={0}-'.format(len(self.server.body) // 2))
+
+    def test_changed_file_restarts(self):
+        # interrupted while the server had an older version of the file
+        old_body = self.server.body
+        self.server.drops = 1
+        self.server.body = old_body
+        with self.assertRaises(Exception):
+            download_file(self.url, self.output_dir, chunk_size=4096,
+                          max_retries=0)
+        self.server.body = os.urandom(len(old_body))
+        self.server.version = 2
+        self._download()
+        self.assertEqual(self._read(), self.server.body)
+
+    def test_part_without_validator_discarded(self):
+        with open(self.local_filename + '.part', 'wb') as f:
+            f.write(b'x' * 1000)
+        self._download()
+        self.assertEqual(self._read(), self.server.body)
+        self.assertNotIn('Range', self.server.requests[0])
+
+    def test_range_ignored(self):
+        self.server.drops = 1
+        self.server.ignore_range = True
+        self._download()
+        self.assertEqual(self._read(), self.server.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+:mod:`test_resume_download` - Resuming batched orders from the job state
+database.
+===============================================================================
+
+Run with ``python -m unittest test_resume_download`` from this folder.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import level2_order_download
+from job_state import JobStore
+from resume_download import resume_orders
+
+SCENE_1 = 'LC08_L1TP_028046_20200101_20200110_01_T1'
+SCENE_2 = 'LC08_L1TP_029046_20200108_20200114_01_T1'
+
+
+class RecordingPool(object):
+    """
+    Stands in for :class:`download_pool.DownloadPool`, recording the folder
+    each item is queued to.
+
+    """
+
+    def __init__(self):
+        self.submitted = {}
+
+    def submit(self, url, data_dir, on_done=None, checksum_url=None,
+               scene_name=None):
+        self.submitted[scene_name] = data_dir
+
+
+class ResumeOrdersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.tmp_dir, 'jobs.db'))
+        # as recorded by level2_order_download.run for a batched order
+        self.store.add_order('o1', None, '028046 029046', '20200101_20201231')
+        self.store.add_items('o1', {SCENE_1: '/data/L2/gz/028046',
+                                    SCENE_2: '/data/L2/gz/029046'})
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _order_row(self, order_id):
+        return self.store._execute('SELECT path_row, date_range, data_dir '
+                                   'FROM orders WHERE order_id = ?', (order_id,))[0]
+
+    def test_batched_order_keeps_its_folders(self):
+        orders = resume_orders(self.store, ['o1', 'o2'], '/tmp/target')
+        self.assertEqual(orders, [('o1', None), ('o2', '/tmp/target')])
+        self.assertEqual(self._order_row('o1'),
+                         ('028046 029046', '20200101_20201231', None))
+        self.assertEqual(self._order_row('o2'), (None, None, '/tmp/target'))
+
+    def test_items_downloaded_to_their_path_row(self):
+        orders = resume_orders(self.store, ['o1'], '/tmp/target')
+        status = {'o1': [{'name': name, 'status': 'complete',
+                          'product_dload_url': 'http://espa/' + name + '.tar.gz'}
+                         for name in (SCENE_1, SCENE_2)]}
+        pool = RecordingPool()
+        with mock.patch.object(level2_order_download, 'espa_api',
+                               return_value=status):
+            level2_order_download.poll_orders(orders, 'user', 'password', pool,
+                                              store=self.store)
+        self.assertEqual(pool.submitted, {SCENE_1: '/data/L2/gz/028046',
+                                          SCENE_2: '/data/L2/gz/029046'})
+
+    def test_folder_does_not_override_item_folders(self):
+        pool = RecordingPool()
+        status = {'o1': [{'name': SCENE_1, 'status': 'complete',
+                          'product_dload_url': 'http://espa/' + SCENE_1 + '.tar.gz'}]}
+        with mock.patch.object(level2_order_download, 'espa_api',
+                               return_value=status):
+            level2_order_download.check_n_download(None, 'o1', '/tmp/target',
+                                                   'user', 'password', pool,
+                                                   store=self.store)
+        self.assertEqual(self.store.item_data_dirs('o1')[SCENE_1],
+                         '/data/L2/gz/028046')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+"""
+:mod:`tiff_band` - Memory-mapped bands of freshly unpacked ESPA scenes.
+===============================================================================
+
+The ESPA GeoTIFFs are uncompressed and stored in strips, one after the other,
+so each band is a plain array at some offset in its file. Only the TIFF
+header and first IFD are parsed (with :mod:`struct`, no GDAL); the pixels are
+then mapped with :class:`numpy.memmap` and read by the page cache as they are
+touched.
+
+Compressed or tiled GeoTIFFs, e.g. scenes converted by :mod:`cog_scenes`,
+cannot be mapped and are refused.
+
+The scene sidecars written while unpacking use this module, and so does
+``analysis/scene_reader.py``, which loads it from this folder. It only needs
+numpy, so unpacking does not depend on the analysis scripts.
+
+"""
+
+import struct
+
+import numpy as np
+
+# TIFF field types: struct format and size
+FIELD_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4),
+               5: ('II', 8), 6: ('b', 1), 7: ('B', 1), 8: ('h', 2),
+               9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8),
+               16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+GDAL_NODATA = 42113
+
+# GeoKey of the EPSG code of a projected crs
+PROJECTED_CS_TYPE = 3072
+
+# numpy kind of each TIFF SampleFormat
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+# bits of the Landsat Collection 1 Level-2 pixel_qa band
+PQ_BITS = {'fill': 0, 'clear': 1, 'water': 2, 'cloud_shadow': 3, 'snow': 4,
+           'cloud': 5}
+
+# the mask of load_combine_mask_discard in the notebooks, whose
+# mask_invalid_data also drops the fill pixels
+CLOUD_FREE = {'fill': False, 'cloud_shadow': False, 'cloud': False}
+
+# pixel_qa flag combinations counted by pixel_qa_summary
+SUMMARY_FLAGS = {'valid': {'fill': False},
+                 'clear': CLOUD_FREE,
+                 'cloud': {'fill': False, 'cloud': True},
+                 'cloud_shadow': {'fill': False, 'cloud_shadow': True},
+                 'water': {'fill': False, 'water': True},
+                 'snow': {'fill': False, 'snow': True}}
+
+
+def read_ifd(f):
+    """
+    Read the tags of the first image of a TIFF or BigTIFF file.
+
+    :param f: the file, opened in binary mode
+
+    :returns: the byte order ('<' or '>') and the tag values keyed by tag,
+              each a tuple, or bytes for ASCII tags
+    :raises ValueError: if the file is not a TIFF or its IFD is truncated
+
+    """
+
+    f.seek(0)
+    header = f.read(16)
+    if header[:2] == b'II':
+        order = '<'
+    elif header[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError('not a TIFF file')
+    try:
+        version = struct.unpack(order + 'H', header[2:4])[0]
+        if version == 42:
+            offset = struct.unpack(order + 'I', header[4:8])[0]
+            count_format, entry_format, inline = 'H', 'HHI', 4
+        elif version == 43:
+            offset = struct.unpack(order + 'Q', header[8:16])[0]
+            count_format, entry_format, inline = 'Q', 'HHQ', 8
+        else:
+            raise ValueError('not a TIFF file')
+
+        f.seek(offset)
+        count_size = struct.calcsize(count_format)
+        n_entries = struct.unpack(order + count_format, f.read(count_size))[0]
+        entry_size = struct.calcsize(order + entry_format) + inline
+        entries = f.read(n_entries * entry_size)
+
+        tags = {}
+        for k in range(n_entries):
+            entry = entries[k * entry_size:(k + 1) * entry_size]
+            tag, field_type, count = struct.unpack(order + entry_format, entry[:-inline])
+            if field_type not in FIELD_TYPES:
+                continue
+            value_format, value_size = FIELD_TYPES[field_type]
+            size = value_size * count
+            if size <= inline:
+                data = entry[-inline:][:size]
+            else:
+                f.seek(struct.unpack(order + ('I' if inline == 4 else 'Q'), entry[-inline:])[0])
+                data = f.read(size)
+            if field_type == 2:
+                tags[tag] = data.rstrip(b'\0')
+            else:
+                tags[tag] = struct.unpack(order + value_format * count, data)
+    except struct.error:
+        raise ValueError('truncated TIFF file')
+    return order, tags
+
+
+class TiffBand(object):
+    """
+    A single band GeoTIFF mapped into memory.
+
+    :param path: the GeoTIFF, uncompressed and in strips
+
+    :raises ValueError: if the pixels are not one contiguous array in the
+                        file, or a required tag is missing
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            order, tags = read_ifd(f)
+
+        if tags.get(COMPRESSION, (1,))[0] != 1 or TILE_WIDTH in tags:
+            raise ValueError('{0} is compressed or tiled; only uncompressed '
+                             'striped GeoTIFFs can be memory-mapped'.format(path))
+        if tags.get(SAMPLES_PER_PIXEL, (1,))[0] != 1:
+            raise ValueError('{0} has more than one band per pixel'.format(path))
+        for tag in (IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, STRIP_OFFSETS,
+                    STRIP_BYTE_COUNTS):
+            if tag not in tags:
+                raise ValueError('{0} lacks TIFF tag {1}'.format(path, tag))
+
+        self.width = tags[IMAGE_WIDTH][0]
+        self.height = tags[IMAGE_LENGTH][0]
+        kind = SAMPLE_KINDS.get(tags.get(SAMPLE_FORMAT, (1,))[0])
+        if kind is None:
+            raise ValueError('{0} has an unsupported sample format'.format(path))
+        self.dtype = np.dtype('{0}{1}{2}'.format(order, kind, tags[BITS_PER_SAMPLE][0] // 8))
+
+        offsets = tags[STRIP_OFFSETS]
+        byte_counts = tags[STRIP_BYTE_COUNTS]
+        contiguous = all(offsets[k] + byte_counts[k] == offsets[k + 1]
+                         for k in range(len(offsets) - 1))
+        if not contiguous or sum(byte_counts) != self.width * self.height * self.dtype.itemsize:
+            raise ValueError('{0} does not store its strips contiguously'.format(path))
+        self.array = np.memmap(path, dtype=self.dtype, mode='r', offset=offsets[0],
+                               shape=(self.height, self.width))
+        self.nodata = float(tags[GDAL_NODATA]) if GDAL_NODATA in tags else None
+        # GDAL order: left, pixel width, 0, top, 0, -pixel height
+        self.transform = None
+        if len(tags.get(MODEL_PIXEL_SCALE, ())) >= 2 and \
+                len(tags.get(MODEL_TIEPOINT, ())) >= 6:
+            scale_x, scale_y = tags[MODEL_PIXEL_SCALE][:2]
+            i, j, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+            self.transform = (x - i * scale_x, scale_x, 0., y + j * scale_y, 0., -scale_y)
+        self.epsg = None
+        keys = tags.get(GEO_KEY_DIRECTORY, ())
+        if len(keys) >= 4:
+            for k in range(4, min(4 + 4 * keys[3], len(keys) - 3), 4):
+                if keys[k] == PROJECTED_CS_TYPE and keys[k + 1] == 0:
+                    self.epsg = keys[k + 3]
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def window(self, row, col, height, width):
+        """
+        Get a window of the band, without reading it.
+
+        :param row: the first row
+        :param col: the first column
+        :param height: the number of rows
+        :param width: the number of columns
+
+        :returns: a read-only (height, width) view of the mapped band
+
+        """
+
+        return self.array[row:row + height, col:col + width]
+
+
+def flag_table(**flags):
+    """
+    Get the table answering, for every 16 bit ``pixel_qa`` value, whether it
+    matches the flags.
+
+    :param flags: the wanted state of each flag, e.g. ``cloud=False``
+
+    :returns: a boolean array of 65536 entries
+    :raises KeyError: for an unknown flag
+
+    """
+
+    values = np.arange(2 ** 16)
+    table = np.ones(2 ** 16, dtype=bool)
+    for flag, wanted in flags.items():
+        table &= ((values >> PQ_BITS[flag]) & 1).astype(bool) == bool(wanted)
+    return table
+
+
+def pixel_qa_summary(band, block_rows=1024):
+    """
+    Count the pixels of a ``pixel_qa`` band by flag. The 16 bit values are
+    histogrammed once, block by block, and each flag combination is then
+    counted from the histogram.
+
+    :param band: the ``pixel_qa`` :class:`TiffBand`
+    :param block_rows: the number of rows read at a time
+
+    :returns: a dictionary with the number of pixels, the number of valid
+              (not fill) pixels and the fraction of the valid pixels that
+              are clear, cloud, cloud_shadow, water and snow
+
+    """
+
+    histogram = np.zeros(2 ** 16, dtype=np.int64)
+    for row in range(0, band.height, block_rows):
+        # native byte order, and int16 pixel_qa reinterpreted as uint16
+        values = band.window(row, 0, block_rows, band.width).astype(np.uint16)
+        histogram += np.bincount(values.ravel(), minlength=2 ** 16)
+
+    counts = dict((name, int(histogram[flag_table(**flags)].sum()))
+                  for name, flags in SUMMARY_FLAGS.items())
+    valid = counts.pop('valid')
+    summary = {'pixels': int(histogram.sum()), 'valid': valid}
+    for name, count in counts.items():
+        summary[name + '_fraction'] = count / float(valid) if valid else 0.
+    return summary
+
+
+def band_statistics(band, block_rows=1024):
+    """
+    Get the minimum, maximum and mean of the valid pixels of a band, reading
+    it block by block.
+
+    :param band: the :class:`TiffBand`
+    :param block_rows: the number of rows read at a time
+
+    :returns: a dictionary with the number of valid (not nodata) pixels and
+              their min, max and mean, None when there are none
+
+    """
+
+    count = 0
+    total = 0.
+    minimum = maximum = None
+    for row in range(0, band.height, block_rows):
+        block = band.window(row, 0, block_rows, band.width)
+        values = block[block != band.nodata] if band.nodata is not None else block.ravel()
+        if not values.size:
+            continue
+        count += values.size
+        total += values.sum(dtype=np.float64)
+        low, high = values.min().item(), values.max().item()
+        minimum = low if minimum is None else min(minimum, low)
+        maximum = high if maximum is None else max(maximum, high)
+    return {'valid': count, 'min': minimum, 'max': maximum,
+            'mean': total / count if count else None}
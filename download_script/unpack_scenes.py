@@ -2,42 +2,311 @@
 
 import argparse
 import glob
+import multiprocessing
 import tarfile
 import os
+import shutil
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xml.etree import ElementTree
+
+from cog_scenes import require_cog, scene_to_cog
+from dataset_docs import DatasetManifest, espa_dataset_doc, write_dataset_doc
+from scene_sidecar import SceneIndex, summarise_band, write_sidecar
+
+
+def scene_name_from_member(member_name):
+    """
+    Derive the scene name (the product id) from the name of any file in an
+    ESPA archive, e.g. LE07_L1TP_018045_20110102_20161210_01_T1_sr_band1.tif
+
+    :param member_name: the name of an archive member
+
+    :returns: the scene name and its path/row
+
+    """
+
+    fields = os.path.basename(member_name).split('.')[0].split('_')
+    return '_'.join(fields[:7]), fields[2]
+
+
+def wanted_member(member_name, scene_name, bands=None):
+    """
+    Decide whether an archive member is extracted. Metadata files are always
+    kept; GeoTIFFs only if their band is in the allowlist.
+
+    :param member_name: the name of an archive member
+    :param scene_name: the scene name the member names start with
+    :param bands: the bands to keep, e.g. ['sr_band1', 'pixel_qa'], None to
+                  keep every band
+
+    :returns: True if the member is to be extracted
+
+    """
+
+    base, ext = os.path.splitext(os.path.basename(member_name))
+    if bands is None or ext.lower() != '.tif':
+        return True
+    return base[len(scene_name) + 1:] in bands
+
+
+def unpack_scene(tar_filepath, target_folder, bands=None, cog=False):
+    """
+    Unpack one scene, reading the gzipped archive exactly once as a stream.
+    The scene folder is named from the first member, filled under a temporary
+    name and only renamed into place once complete; the archive is then
+    deleted. The ESPA XML metadata is parsed as it streams past and the
+    datacube dataset document of the scene is written next to its bands,
+    along with a sidecar of its statistics and quicklook, computed from each
+    band just after it is extracted.
+    Optionally the bands are rewritten as Cloud-Optimized GeoTIFFs before the
+    scene folder is renamed into place.
+
+    :param tar_filepath: the gzipped/tarred scene
+    :param target_folder: the folder holding a subfolder per path/row
+    :param bands: the bands to extract, None for all; metadata files are
+                  always extracted
+    :param cog: True to rewrite the bands as Cloud-Optimized GeoTIFFs
+
+    :returns: the scene folder, or None if the scene was already unpacked
+
+    """
+
+    out_folder = None
+    tmp_folder = None
+    xml_root = None
+    tif_files = []
+    statistics = {}
+    quicklooks = {}
+    # the 'data' filter refuses members escaping the scene folder
+    extract_args = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+    with tarfile.open(tar_filepath, mode='r|gz') as tf:
+        for member in tf:
+            if out_folder is None:
+                if not member.isfile():
+                    continue
+                scene_name, path_row = scene_name_from_member(member.name)
+                path_row_folder = os.path.join(target_folder, path_row)
+                out_folder = os.path.join(path_row_folder, scene_name)
+                if os.path.isdir(out_folder):
+                    return None
+                tmp_folder = out_folder + '.tmp'
+                if os.path.isdir(tmp_folder):
+                    shutil.rmtree(tmp_folder)
+                os.makedirs(tmp_folder)
+            if not wanted_member(member.name, scene_name, bands):
+                continue
+            member_file = os.path.basename(member.name)
+            if member.isfile() and member_file == scene_name + '.xml':
+                # a stream can be read only once: keep the bytes to parse
+                xml_bytes = tf.extractfile(member).read()
+                with open(os.path.join(tmp_folder, member_file), 'wb') as f:
+                    f.write(xml_bytes)
+                xml_root = ElementTree.fromstring(xml_bytes)
+            else:
+                tf.extract(member, tmp_folder, **extract_args)
+                if member_file.lower().endswith('.tif'):
+                    tif_files.append(member_file)
+                    # the sidecar is a convenience: no band it cannot read
+                    # stops the scene being unpacked
+                    try:
+                        name, statistics[name], quicklooks[name] = summarise_band(
+                            os.path.join(tmp_folder, member.name), scene_name)
+                    except Exception:
+                        print("Oops!", '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                                         sys.exc_info()[1]), "occured.")
+                        print('no sidecar statistics for: ' + member_file)
+
+    if xml_root is not None:
+        try:
+            write_dataset_doc(espa_dataset_doc(xml_root, scene_name, tif_files),
+                              tmp_folder)
+        except (ImportError, ValueError):
+            print("Oops!", sys.exc_info()[1], "occured.")
+            print('no dataset document for: ' + scene_name)
+    if statistics:
+        try:
+            write_sidecar(scene_name, statistics, quicklooks, tmp_folder)
+        except Exception:
+            print("Oops!", '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                             sys.exc_info()[1]), "occured.")
+            print('no sidecar for: ' + scene_name)
+    if cog:
+        scene_to_cog(tmp_folder)
+    os.rename(tmp_folder, out_folder)
+    os.unlink(tar_filepath)
+    return out_folder
+
+
+def _unpack_scene(tar_filepath, target_folder, bands=None, cog=False):
+    """
+    Unpack one scene in a worker process, reporting rather than raising
+    errors so one bad archive does not stop the others.
+
+    """
+
+    try:
+        return unpack_scene(tar_filepath, target_folder, bands, cog), None
+    except Exception:
+        return None, '{0}: {1}'.format(sys.exc_info()[0].__name__,
+                                       sys.exc_info()[1])
+
+
+def unpack_all(tar_files, target_folder, workers=None, bands=None, cog=False,
+               manifest=None, index=None):
+    """
+    Unpack many scenes concurrently.
+
+    :param tar_files: a list of gzipped/tarred scenes
+    :param target_folder: the folder holding a subfolder per path/row
+    :param workers: the number of worker processes, defaults to the number of
+                    CPUs
+    :param bands: the bands to extract, None for all
+    :param cog: True to rewrite the bands as Cloud-Optimized GeoTIFFs
+    :param manifest: an optional file collecting the dataset documents of the
+                     unpacked scenes for bulk indexing
+    :param index: an optional database indexing the sidecars of the unpacked
+                  scenes, see :class:`scene_sidecar.SceneIndex`
+
+    :returns: a list of the archives that could not be unpacked
+    :raises ImportError: if ``cog`` is set and rasterio is not installed
+
+    """
+
+    if cog:
+        require_cog()
+    failed = []
+    manifest = DatasetManifest(manifest) if manifest else None
+    index = SceneIndex(index) if index else None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_unpack_scene, tar_filepath,
+                                        target_folder, bands, cog),
+                                        tar_filepath)
+                       for tar_filepath in tar_files)
+        for future in as_completed(futures):
+            tar_filepath = futures[future]
+            out_folder, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping: ' + tar_filepath)
+                failed.append(tar_filepath)
+            elif out_folder is None:
+                print('skipping: ' + tar_filepath + ' (already unpacked)')
+            else:
+                if manifest is not None:
+                    manifest.add(out_folder)
+                if index is not None:
+                    index.add(out_folder)
+                print('scene {0} complete'.format(out_folder))
+    return failed
+
+
+class UnpackPipeline(object):
+    """
+    Unpack downloaded scenes as soon as each download finishes, so archives
+    do not pile up on disk waiting for a separate unpacking run. At most
+    ``queue_size`` archives wait for or are being unpacked at any time; when
+    the queue is full the caller (a download worker) blocks, holding back
+    further downloads until the unpackers catch up.
+
+    :param target_folder: the folder holding a subfolder per path/row
+    :param workers: the number of unpacking processes
+    :param queue_size: the most archives queued or being unpacked at once
+    :param bands: the bands to extract, None for all
+    :param cog: True to rewrite the bands as Cloud-Optimized GeoTIFFs
+    :param manifest: an optional file collecting the dataset documents of the
+                     unpacked scenes for bulk indexing
+    :param index: an optional database indexing the sidecars of the unpacked
+                  scenes, see :class:`scene_sidecar.SceneIndex`
+
+    :raises ImportError: if ``cog`` is set and rasterio is not installed
+
+    """
+
+    def __init__(self, target_folder, workers=2, queue_size=8, bands=None,
+                 cog=False, manifest=None, index=None):
+        if cog:
+            require_cog()
+        self.target_folder = target_folder
+        self.bands = bands
+        self.cog = cog
+        self.manifest = DatasetManifest(manifest) if manifest else None
+        self.index = SceneIndex(index) if index else None
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.failed = []
+        # spawned rather than forked workers, as the downloads run in threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _done(self, tar_filepath):
+        def done(future):
+            self.slots.release()
+            out_folder, error = future.result()
+            if error is not None:
+                print("Oops!", error, "occured.")
+                print('skipping: ' + tar_filepath)
+                with self.lock:
+                    self.failed.append(tar_filepath)
+            elif out_folder is not None:
+                if self.manifest is not None:
+                    self.manifest.add(out_folder)
+                if self.index is not None:
+                    self.index.add(out_folder)
+                print('scene {0} complete'.format(out_folder))
+        return done
+
+    def submit(self, tar_filepath):
+        """
+        Queue a downloaded archive for unpacking, blocking while the queue is
+        full.
+
+        :param tar_filepath: the gzipped/tarred scene
+
+        """
+
+        self.slots.acquire()
+        future = self.executor.submit(_unpack_scene, tar_filepath,
+                                      self.target_folder, self.bands, self.cog)
+        future.add_done_callback(self._done(tar_filepath))
+
+    def wait(self):
+        """
+        Wait for every queued archive to be unpacked and stop the workers.
+
+        :returns: a list of the archives that could not be unpacked
+
+        """
+
+        self.executor.shutdown(wait=True)
+        return list(self.failed)
 
 
 def untar_scenes():
     parser = argparse.ArgumentParser(description='Unpack USGS Landsat scenes.')
     parser.add_argument('source_folder', help='path to your gzipped/tarred USGS Landsat scenes')
     parser.add_argument('target_folder', help='path to your ungzipped/untarred USGS Landsat scenes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of scenes unpacked in parallel (default: number of CPUs)')
+    parser.add_argument('--bands', nargs='+', default=None,
+                        help='bands to extract, e.g. sr_band1 sr_band2 pixel_qa (default: all); '
+                             'metadata files are always extracted')
+    parser.add_argument('--cog', action='store_true',
+                        help='rewrite the bands as Cloud-Optimized GeoTIFFs (requires rasterio)')
+    parser.add_argument('--manifest', default=None,
+                        help='file collecting the datacube dataset documents of the unpacked scenes, '
+                             'for indexing them all with one "datacube dataset add"')
+    parser.add_argument('--index', default=None,
+                        help='SQLite index of the statistics sidecars of the unpacked scenes, '
+                             'created if missing')
     args = parser.parse_args()
     source_folder = args.source_folder
     target_folder = args.target_folder
     tar_files = glob.glob(source_folder + '/*.tar.gz')  # a glob file containing the names of all .tar.gz
-    for tar_filepath in tar_files:
-        try:
-            with tarfile.open(tar_filepath) as tf:
-                xml = [n for n in tf.getnames() if n[-3:] == 'xml'][0]
-                xml_folder = xml[10:16]
-                scene_name = xml.split('.')[0]
-                path_row_folder = target_folder + '/' + xml_folder
-                out_folder = path_row_folder + '/' + scene_name
-                print(out_folder)
-                print(tar_filepath)
-                if not os.path.isdir(path_row_folder):
-                    os.mkdir(path_row_folder)
-                try:
-                    os.mkdir(out_folder)
-                    tf.extractall(out_folder)
-                    os.unlink(tar_filepath)
-                    print('scene {0} complete'.format(str(xml)))
-                except:
-                    print("Oops!", sys.exc_info()[0], "occured.")
-                    print('skipping: '+tar_filepath)
-        except:
-            print("Oops!", sys.exc_info()[0], "occured.")
-            print('skipping: ' + tar_filepath)
+    unpack_all(tar_files, target_folder, args.workers, args.bands, args.cog,
+               args.manifest, args.index)
 
 
 if __name__ == '__main__':